@@ -0,0 +1,282 @@
+import os
+import socket
+import asyncio
+
+from openocd import OpenOCDSession, free_port
+from stlink import SRAM_BASE
+
+
+# Log sources
+RTT = 'rtt'
+SWO = 'swo'
+
+DEFAULT_CAPACITY = 64 * 1024
+
+# Seconds to wait for the firmware to set up its RTT control block after reset
+RTT_SEARCH_TIMEOUT = 5
+
+
+class RingBuffer:
+    """
+    A fixed size byte ring. Data is received straight into it (see write_view()) and read back as views
+    into it, so nothing is copied on the way through. When it is full the oldest data is dropped to make
+    room, and counted in dropped.
+    Positions are the total number of bytes written before that point, so they keep increasing.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.head = 0       # position of the next byte written
+        self.tail = 0       # position of the oldest unread byte
+        self.dropped = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def write_view(self, drop=None):
+        """
+        Gets the free space after the newest data, to receive into. commit() must be called with the number of
+        bytes written to it. If the ring is full, unread data is dropped first.
+        :param drop: how many bytes to drop when full, defaults to an eighth of the capacity
+        """
+        if len(self) == self.capacity:
+            dropped = min(len(self), drop or max(self.capacity // 8, 1))
+            self.tail += dropped
+            self.dropped += dropped
+
+        start = self.head % self.capacity
+        end = min(self.capacity, start + self.capacity - len(self))
+        return self.view[start:end]
+
+    def commit(self, count):
+        self.head += count
+
+    def write(self, data):
+        """
+        Copies data in, for sources that can't receive into write_view()
+        """
+        data = memoryview(data)
+        while len(data):
+            view = self.write_view(len(data))
+            count = min(len(view), len(data))
+            view[:count] = data[:count]
+            self.commit(count)
+            data = data[count:]
+
+    def read_views(self):
+        """
+        Gets the unread data without copying it. The views are only valid until more data is written, use
+        bytes() on them to keep the data.
+        :return: ([memoryview, ...], position to pass to consume() once they have been used)
+        """
+        start = self.tail % self.capacity
+        end = start + len(self)
+        if end <= self.capacity:
+            views = [self.view[start:end]]
+        else:
+            views = [self.view[start:], self.view[:end - self.capacity]]
+        return views, self.head
+
+    def consume(self, position):
+        """
+        Marks everything before position as read
+        """
+        self.tail = max(self.tail, min(position, self.head))
+
+
+class LogCapture:
+    """
+    Streams a target's log output from the moment it is reset. The target is reset through an OpenOCD
+    session that stays open, and RTT (or SWO) data is read from OpenOCD's TCP server into a RingBuffer on
+    an asyncio event loop, so any number of probes can be captured from one thread without polling.
+
+        async with LogCapture(stlink) as capture:
+            async for chunk in capture:
+                ...
+
+    Chunks are memoryviews into the ring, only valid until the next one is requested.
+    """
+    def __init__(self, stlink, source=RTT, channel=0, capacity=DEFAULT_CAPACITY, trace_clock=None,
+                 swo_frequency=2000000, session=None):
+        """
+        :param stlink: STLink of the device to capture from
+        :param source: RTT or SWO
+        :param channel: RTT up channel to read, ignored for SWO
+        :param capacity: ring buffer size in bytes, the oldest data is dropped when a reader falls behind
+        :param trace_clock: for SWO, the target's core clock in Hz once the firmware is running
+        :param swo_frequency: for SWO, the SWO pin frequency in Hz
+        :param session: OpenOCDSession to use, one is opened if not given
+        """
+        if source not in (RTT, SWO):
+            raise ValueError("Unknown log source %r, use RTT or SWO." % source)
+        if source == SWO and not trace_clock:
+            raise ValueError("SWO capture needs the target's trace_clock.")
+
+        self.stlink = stlink
+        self.source = source
+        self.channel = channel
+        self.trace_clock = trace_clock
+        self.swo_frequency = swo_frequency
+        self.ring = RingBuffer(capacity)
+        self.session = session
+        self._owns_session = session is None
+
+        self.socket = None
+        self.closed = False
+        self._data = asyncio.Event()
+        self._pump = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def start(self):
+        """
+        Resets the target and starts streaming its output into the ring
+        """
+        loop = asyncio.get_running_loop()
+        port = free_port()
+
+        try:
+            # OpenOCD commands block, so they run in the default executor rather than on the event loop
+            if self.session is None:
+                self.session = await loop.run_in_executor(None, OpenOCDSession, self.stlink.stlink)
+            await loop.run_in_executor(None, self._setup, port)
+
+            # The target stays halted until the socket is connected, so nothing it sends is lost on the way
+            self.socket = socket.socket()
+            self.socket.setblocking(False)
+            await loop.sock_connect(self.socket, ('localhost', port))
+            self._pump = asyncio.ensure_future(self._receive())
+
+            await loop.run_in_executor(None, self.session.command, "resume",
+                                       "Failed resuming device %s" % self.stlink.stlink.name)
+        except BaseException:
+            # __aexit__ doesn't run when __aenter__ fails, so don't leave OpenOCD holding the probe
+            await self.close()
+            raise
+
+    def _setup(self, port):
+        """
+        Resets the target and starts OpenOCD's server for the log, leaving the target halted.
+        With RTT the firmware has to run until it has set up its control block, and whatever it logs before
+        the control block is found is held in its RTT up buffer. Anything beyond the buffer's size is lost
+        (or stalls the firmware, if the channel is in blocking mode), so the buffer should be sized for the
+        startup output.
+        """
+        name = self.stlink.stlink.name
+
+        self.session.command("reset halt", "Failed resetting device %s" % name)
+        if self.source == RTT:
+            self.session.command('rtt setup 0x%08x %d "SEGGER RTT"' % (SRAM_BASE, self.stlink.sram_size))
+            self.session.command("resume")
+
+            # The control block only exists once the firmware has started, so keep looking for it
+            self.session.command("set _end [expr {[clock milliseconds] + %d}]; rtt start; "
+                                 "while {[catch {rtt channels}]} {"
+                                 "if {[clock milliseconds] > $_end} {error {no RTT control block found}}; "
+                                 "sleep 10; rtt start}" % (RTT_SEARCH_TIMEOUT * 1000),
+                                 "No RTT control block found on device %s" % name)
+            self.session.command("halt")
+            self.session.command("rtt server start %d %d" % (port, self.channel),
+                                 "Failed starting the RTT server for device %s" % name)
+        else:
+            tpiu = "[regsub {\\.[^.]*$} [target current] {}].tpiu"
+            self.session.command("%s configure -protocol uart -output :%d -traceclk %d -pin-freq %d" %
+                                 (tpiu, port, self.trace_clock, self.swo_frequency),
+                                 "Failed configuring SWO on device %s" % name)
+            self.session.command("%s enable" % tpiu)
+            self.session.command("itm port 0 on")
+
+    async def _receive(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                count = await loop.sock_recv_into(self.socket, self.ring.write_view())
+                if not count:
+                    break
+                self.ring.commit(count)
+                self._data.set()
+                # sock_recv_into() doesn't suspend while data is waiting, let readers drain the ring
+                await asyncio.sleep(0)
+        finally:
+            self.closed = True
+            self._data.set()
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        while True:
+            if not len(self.ring):
+                if self.closed:
+                    return
+                self._data.clear()
+                await self._data.wait()
+                continue
+
+            views, position = self.ring.read_views()
+            for view in views:
+                yield view
+            self.ring.consume(position)
+
+    async def to_file(self, path, duration=None):
+        """
+        Writes the captured output to a file
+        :param path: file to write, appended to if it exists
+        :param duration: seconds to capture for, or None to capture until the connection closes
+        :return: number of bytes written
+        """
+        written = 0
+
+        async def copy():
+            nonlocal written
+            with open(path, 'ab') as file:
+                async for chunk in self:
+                    file.write(chunk)
+                    written += len(chunk)
+                    file.flush()
+
+        try:
+            await asyncio.wait_for(copy(), duration)
+        except asyncio.TimeoutError:
+            pass
+
+        return written
+
+    async def close(self):
+        if self._pump is not None:
+            self._pump.cancel()
+            try:
+                await self._pump
+            except asyncio.CancelledError:
+                pass
+            self._pump = None
+
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+        if self.session is not None and self._owns_session:
+            await asyncio.get_running_loop().run_in_executor(None, self.session.close)
+            self.session = None
+
+
+async def capture_to_files(stlinks, directory, duration, **options):
+    """
+    Resets every device and captures its output to <directory>/<serial>.log, all on the current event loop
+    :param stlinks: STLinks of the devices to capture from
+    :param duration: seconds to capture for
+    :param options: passed on to LogCapture
+    :return: {serial: bytes captured}
+    """
+    async def capture_one(stlink):
+        path = os.path.join(directory, "%s.log" % stlink.stlink.serial_number)
+        async with LogCapture(stlink, **options) as capture:
+            return stlink.stlink.serial_number, await capture.to_file(path, duration)
+
+    return dict(await asyncio.gather(*(capture_one(stlink) for stlink in stlinks)))
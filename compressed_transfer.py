@@ -0,0 +1,305 @@
+import os
+import re
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from compression import compress, max_compressed_size
+from openocd import OpenOCDSession
+from stlink import FLASH_BASE, SRAM_BASE, flash_changed
+from stm32devices import find_parts, sector_number
+from tools import FlashError, VERIFY_MISMATCH
+
+
+STUB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub', 'decompress_stub.bin')
+
+# SRAM layout shared with stub/decompress_stub.c: the stub and its stack, the mailbox, then the buffers
+STUB_AREA = 0x1000
+MAILBOX = SRAM_BASE + STUB_AREA
+SLOTS = MAILBOX + 0x10
+SLOT_COUNT = 2
+SLOT_SIZE = 32
+BUFFERS = MAILBOX + 0x100
+
+# Mailbox words
+MAILBOX_MAGIC = MAILBOX
+MAILBOX_OUTPUT = MAILBOX + 4
+STUB_MAGIC = 0x42555453
+
+# Slot words: state, input, compressed length, raw length, destination, flags, status
+SLOT_STATE = 0
+SLOT_STATUS = 24
+SLOT_EMPTY = 0
+SLOT_READY = 1
+SLOT_DONE = 2
+
+FLAG_ERASE = 1 << 0
+FLAG_RAW = 1 << 1
+
+STATUS_VERIFY_FAIL = 0x100
+
+DEFAULT_BLOCK_SIZE = 16 * 1024
+MIN_BLOCK_SIZE = 1024
+
+# Flash driver of the parts the stub knows how to program (F2/F4/F7)
+STUB_FLASH_DRIVER = 'STM32FS'
+
+
+def _payload(data, compressed):
+    payload = compress(data) if compressed else data
+    return payload if len(payload) < len(data) else None
+
+
+def stub_layout(sram_size, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Works out where the stub's buffers go, shrinking the block size until they fit in SRAM
+    :param sram_size: size in bytes of the part's SRAM
+    :param block_size: preferred uncompressed block size
+    :return: (block_size, output buffer address, [input buffer address of each slot])
+    """
+    while block_size >= MIN_BLOCK_SIZE:
+        slot_size = (max_compressed_size(block_size) + 3) & ~3
+        inputs = [BUFFERS + block_size + index * slot_size for index in range(SLOT_COUNT)]
+        if inputs[-1] + slot_size <= SRAM_BASE + sram_size:
+            return block_size, BUFFERS, inputs
+        block_size //= 2
+
+    raise ValueError("%d bytes of SRAM is not enough for the decompression stub." % sram_size)
+
+
+class OpenOCDTarget:
+    """
+    Memory access to a target through an OpenOCD session, as used by CompressedWriter
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def write_memory(self, address, data):
+        with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as file:
+            file.write(data)
+        try:
+            self.session.command("load_image {%s} 0x%08x bin" % (file.name, address),
+                                 "Failed writing %d bytes to 0x%08x" % (len(data), address))
+        finally:
+            os.remove(file.name)
+
+    def write_words(self, address, words):
+        self.session.command("; ".join("mww 0x%08x 0x%08x" % (address + 4 * index, word)
+                                       for index, word in enumerate(words)))
+
+    def read_word(self, address):
+        result = self.session.command("mdw 0x%08x" % address)
+        match = re.search(r"0x[0-9a-f]+:\s*([0-9a-f]+)", result, re.I)
+        if not match:
+            raise RuntimeError("Could not read 0x%08x: %s" % (address, result))
+        return int(match.group(1), 16)
+
+    def wait_while(self, address, value, timeout=10):
+        """
+        Waits for a word to change from value. The loop runs inside OpenOCD, not across the TCL connection.
+        """
+        self.session.command("set _end [expr {[clock milliseconds] + %d}]; "
+                             "while {[mrw 0x%08x] == %d} {"
+                             "if {[clock milliseconds] > $_end} {error {timed out waiting for 0x%08x}}; "
+                             "sleep 1}" % (timeout * 1000, address, value, address),
+                             "Timed out waiting for the stub")
+
+    def reset_halt(self):
+        self.session.command("reset halt")
+
+    def start(self, entry, stack_pointer):
+        self.session.command("reg msp 0x%08x" % stack_pointer)
+        self.session.command("reg pc 0x%08x" % (entry & ~1))
+        self.session.command("resume")
+
+    def halt(self):
+        self.session.command("halt")
+
+
+class CompressedWriter:
+    """
+    Programs images through a small stub running in the target's SRAM. The host sends LZSS compressed
+    blocks (see compression.py) into two mailbox slots. The stub decompresses each one, erases its sector
+    when it is the first block there, programs and verifies it, while the host is already sending the next
+    block into the other slot. Far fewer bytes cross the SWD link, which is the slow part of a normal write.
+    Blocks that don't compress are sent raw, so nothing is ever larger than a plain write.
+    The tests run against simulator.SimulatedTarget, which emulates the stub's side of the protocol in
+    Python. The stub itself is only checked by 'make -C stub check' (build and size), it has not been run on
+    hardware by the tests.
+    """
+    def __init__(self, target, sectors, sram_size, name='', block_size=DEFAULT_BLOCK_SIZE, stub_file=STUB_FILE,
+                 sector_numbers=None, serial=None):
+        """
+        :param target: OpenOCDTarget (or simulator.SimulatedTarget) giving access to the target's memory
+        :param sectors: (offset, size) of each flash sector, see STLink.sectors
+        :param sram_size: size in bytes of the target's SRAM
+        :param name: device name used in errors
+        :param block_size: preferred uncompressed block size, reduced to fit small SRAMs
+        :param stub_file: the stub binary, built with 'make -C stub'. Not needed for simulated targets.
+        :param sector_numbers: the flash controller's number for each sector (see stm32devices.sector_number),
+                               defaults to their index in sectors
+        :param serial: serial number of the probe, to note flash changes against (see stlink.flash_changed())
+        """
+        if getattr(target, 'emulates_stub', False):
+            # Simulated targets run the stub themselves, they only need a vector table to start it
+            self.stub = struct.pack('<II', MAILBOX, SRAM_BASE | 1)
+        elif not os.path.exists(stub_file):
+            raise FileNotFoundError("Decompression stub %s not found, build it with 'make -C stub'." % stub_file)
+        else:
+            with open(stub_file, 'rb') as file:
+                self.stub = file.read()
+
+        if len(self.stub) > STUB_AREA:
+            raise ValueError("%s is %d bytes, the stub area is %d bytes." % (stub_file, len(self.stub), STUB_AREA))
+
+        self.target = target
+        self.sectors = sectors
+        self.sector_numbers = sector_numbers or list(range(len(sectors)))
+        self.name = name
+        self.serial = serial
+        self.block_size, self.output_buffer, self.input_buffers = stub_layout(sram_size, block_size)
+        self._owned_session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._owned_session is not None:
+            self._owned_session.close()
+            self._owned_session = None
+
+    @classmethod
+    def from_stlink(cls, stlink, session=None, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        :param stlink: STLink of the device to program, only parts using the STM32FS flash driver are supported
+        :param session: OpenOCDSession to use, one is opened if not given
+        """
+        parts = find_parts(stlink.stlink.chip_id)
+        if not parts or parts[0].flash_driver != STUB_FLASH_DRIVER:
+            raise ValueError("Compressed transfers are not supported on device %s (chip id 0x%x)." %
+                             (stlink.stlink.name, stlink.stlink.chip_id))
+
+        owned_session = None if session else OpenOCDSession(stlink.stlink)
+        try:
+            sectors = stlink.sectors
+            writer = cls(OpenOCDTarget(session or owned_session), sectors, stlink.sram_size, stlink.stlink.name,
+                         block_size, sector_numbers=[sector_number(parts[0], index) for index in range(len(sectors))],
+                         serial=stlink.stlink.serial_number)
+        except Exception:
+            if owned_session:
+                owned_session.close()
+            raise
+
+        writer._owned_session = owned_session
+        return writer
+
+    def blocks(self, image, offset):
+        """
+        Splits an image into blocks that each fit in one sector
+        :param image: the image bytes
+        :param offset: where the image goes, relative to FLASH_BASE
+        :return: list of (offset, data, sector index, first block in the sector)
+        """
+        blocks = []
+        end = offset + len(image)
+
+        for index, (sector_offset, sector_size) in enumerate(self.sectors):
+            start = max(offset, sector_offset)
+            stop = min(end, sector_offset + sector_size)
+            first = True
+            while start < stop:
+                size = min(self.block_size, stop - start)
+                blocks.append((start, image[start - offset:start - offset + size], index, first))
+                start += size
+                first = False
+
+        if blocks and blocks[-1][0] + len(blocks[-1][1]) < end:
+            raise ValueError("Image at offset 0x%x of %d bytes does not fit in flash." % (offset, len(image)))
+
+        return blocks
+
+    def write(self, binary_file, link_address="0x08000000", compressed=True):
+        """
+        Programs a binary through the stub, leaving the target halted
+        :param binary_file: absolute path to the binary to be flashed
+        :param link_address: program flash link address
+        :param compressed: set to False to send every block raw, as a baseline
+        :return: dict of raw_bytes, sent_bytes, ratio and seconds
+        """
+        with open(binary_file, 'rb') as file:
+            image = file.read()
+        offset = int(link_address, 16) - FLASH_BASE
+
+        blocks = self.blocks(image, offset)
+        if self.serial is not None:
+            flash_changed(self.serial)
+        start = time.perf_counter()
+
+        # Blocks are compressed in other processes while the stub starts and earlier blocks are sent
+        with ProcessPoolExecutor() as workers:
+            payloads = workers.map(_payload, [data for _, data, _, _ in blocks], [compressed] * len(blocks))
+            self._start_stub()
+
+            sent_bytes = 0
+            pending = [None] * SLOT_COUNT
+            for number, ((block_offset, data, sector, first), payload) in enumerate(zip(blocks, payloads)):
+                slot = number % SLOT_COUNT
+                if pending[slot] is not None:
+                    self._finish(slot, pending[slot])
+
+                flags = (self.sector_numbers[sector] << 8) | (FLAG_ERASE if first else 0)
+                if payload is None:
+                    payload = data
+                    flags |= FLAG_RAW
+
+                self._send(slot, payload, len(data), FLASH_BASE + block_offset, flags)
+                pending[slot] = block_offset
+                sent_bytes += len(payload)
+
+            for slot, block_offset in enumerate(pending):
+                if block_offset is not None:
+                    self._finish(slot, block_offset)
+
+        self.target.halt()
+        seconds = time.perf_counter() - start
+
+        return {'raw_bytes': len(image),
+                'sent_bytes': sent_bytes,
+                'ratio': sent_bytes / len(image) if image else 1.0,
+                'seconds': seconds}
+
+    def _start_stub(self):
+        self.target.reset_halt()
+        self.target.write_memory(SRAM_BASE, self.stub)
+        self.target.write_words(MAILBOX, [0, self.output_buffer, 0, 0] + [0] * (SLOT_COUNT * SLOT_SIZE // 4))
+
+        stack_pointer, entry = struct.unpack_from('<II', self.stub)
+        self.target.start(entry, stack_pointer)
+        self.target.wait_while(MAILBOX_MAGIC, 0)
+
+        if self.target.read_word(MAILBOX_MAGIC) != STUB_MAGIC:
+            raise FlashError("Decompression stub did not start on device %s" % self.name)
+
+    def _send(self, slot, payload, raw_length, destination, flags):
+        address = SLOTS + slot * SLOT_SIZE
+        self.target.write_memory(self.input_buffers[slot], payload)
+        # Everything but the state first, the stub picks the slot up as soon as it reads READY
+        self.target.write_words(address + 4, [self.input_buffers[slot], len(payload), raw_length, destination,
+                                              flags, 0])
+        self.target.write_words(address + SLOT_STATE, [SLOT_READY])
+
+    def _finish(self, slot, block_offset):
+        address = SLOTS + slot * SLOT_SIZE
+        self.target.wait_while(address + SLOT_STATE, SLOT_READY)
+
+        status = self.target.read_word(address + SLOT_STATUS)
+        if status == STATUS_VERIFY_FAIL:
+            raise FlashError("Verification failed at offset 0x%x on device %s" % (block_offset, self.name),
+                             VERIFY_MISMATCH, offset=block_offset)
+        if status:
+            raise FlashError("Flash error 0x%02x at offset 0x%x on device %s" % (status, block_offset, self.name),
+                             offset=block_offset)
@@ -0,0 +1,131 @@
+"""
+A small LZSS codec for firmware images. The format is deliberately simple so that the decoder fits in a
+few hundred bytes of target code (see stub/decompress_stub.c):
+
+    The data is a series of groups: one flag byte followed by up to 8 items. Bit n of the flag byte
+    (least significant first) describes item n:
+        0: a literal byte
+        1: a back reference, a little endian 16 bit word ((offset - 1) << 4) | (length - 3), which
+           copies length bytes starting offset bytes back in the output
+
+Decoding stops once the expected number of output bytes has been produced.
+"""
+
+WINDOW_SIZE = 4096
+MIN_MATCH = 3
+MAX_MATCH = 18
+
+# How many earlier positions to try for each match, trades compression ratio for speed
+MAX_CHAIN = 32
+
+
+def compress(data):
+    """
+    :param data: bytes to compress
+    :return: compressed bytes
+    """
+    data = bytes(data)
+    output = bytearray()
+    chains = {}
+
+    flags = 0
+    flag_bit = 0
+    flag_index = len(output)
+    output.append(0)
+
+    position = 0
+    while position < len(data):
+        best_length = 0
+        best_offset = 0
+
+        key = data[position:position + MIN_MATCH]
+        candidates = chains.get(key, ())
+        limit = min(MAX_MATCH, len(data) - position)
+
+        for candidate in reversed(candidates[-MAX_CHAIN:]):
+            offset = position - candidate
+            if offset > WINDOW_SIZE:
+                break
+
+            length = MIN_MATCH
+            while length < limit and data[candidate + length] == data[position + length]:
+                length += 1
+
+            if length > best_length:
+                best_length = length
+                best_offset = offset
+                if length == limit:
+                    break
+
+        if flag_bit == 8:
+            output[flag_index] = flags
+            flags = 0
+            flag_bit = 0
+            flag_index = len(output)
+            output.append(0)
+
+        if best_length >= MIN_MATCH:
+            flags |= 1 << flag_bit
+            word = ((best_offset - 1) << 4) | (best_length - MIN_MATCH)
+            output += bytes((word & 0xFF, word >> 8))
+            step = best_length
+        else:
+            output.append(data[position])
+            step = 1
+
+        for index in range(position, position + step):
+            if index + MIN_MATCH <= len(data):
+                chain = chains.setdefault(data[index:index + MIN_MATCH], [])
+                chain.append(index)
+                if len(chain) > 2 * MAX_CHAIN:
+                    del chain[:MAX_CHAIN]
+
+        position += step
+        flag_bit += 1
+
+    output[flag_index] = flags
+    return bytes(output)
+
+
+def decompress(data, size):
+    """
+    Reference decoder, it works exactly like the target stub
+    :param data: compressed bytes
+    :param size: number of bytes to produce
+    :return: decompressed bytes
+    """
+    output = bytearray()
+    index = 0
+
+    while len(output) < size:
+        flags = data[index]
+        index += 1
+
+        for bit in range(8):
+            if len(output) >= size:
+                break
+
+            if flags & (1 << bit):
+                word = data[index] | (data[index + 1] << 8)
+                index += 2
+                offset = (word >> 4) + 1
+                length = (word & 0xF) + MIN_MATCH
+
+                if offset > len(output):
+                    raise ValueError("Corrupt compressed data, reference before start of output")
+
+                start = len(output) - offset
+                for copy in range(length):
+                    output.append(output[start + copy])
+            else:
+                output.append(data[index])
+                index += 1
+
+    return bytes(output[:size])
+
+
+def max_compressed_size(size):
+    """
+    Worst case size of compressed data, when nothing matches (every 8 literals gain a flag byte)
+    """
+    return size + (size + 7) // 8
@@ -0,0 +1,484 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import inventory
+from prestage import Job
+from records import ProbeRecord
+from stlink import STLink, STLink_USBInterface
+from tools import COMMAND_TIMEOUT, UNKNOWN, FlashError
+
+
+DEFAULT_PORT = 8700
+
+# Images are hashed and sent in pieces of this size
+BLOCK_SIZE = 64 * 1024
+
+
+def image_hash(binary_file):
+    """
+    :return: the sha256 of a binary file, as used to name images on agents
+    """
+    digest = hashlib.sha256()
+    with open(binary_file, 'rb') as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _is_image_hash(value):
+    # Hashes name files on the agent, so anything else (eg a path) must never get as far as image_path()
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+class LocalBackend:
+    """
+    The probes attached to this host, driven through STLink_USBInterface and STLink
+    """
+    def __init__(self, history=None):
+        """
+        :param history: optional performance.PerformanceHistory that discovery and flash times are recorded in
+        """
+        self.history = history
+        self.records = {}
+
+    def discover(self, busy=()):
+        """
+        :param busy: serials of probes being flashed. st-info can't open them, so their records are kept.
+        """
+        usb_interface = STLink_USBInterface(self.history)
+        usb_interface.discover_devices()
+        records = {record.serial: record for record in usb_interface.found_devices}
+        records.update({serial: self.records[serial] for serial in busy if serial in self.records})
+        self.records = records
+        return list(records.values())
+
+    def flash(self, serial, binary_file, link_address="0x08000000"):
+        board_interface = STLink_USBInterface()
+        board_interface.attach_device(self.records[serial])
+        STLink(board_interface, self.history).flash(binary_file, link_address)
+
+
+class Agent:
+    """
+    Serves one host's probes over HTTP so a Coordinator can flash them:
+
+        GET  /boards                  every attached probe, as ProbeRecord dictionaries with a 'busy' flag
+        GET  /boards?refresh=1        the same, after discovering the probes again
+        HEAD /images/<sha256>         200 if the image is already on this host, 404 otherwise
+        PUT  /images/<sha256>         stores an image, rejected if its content doesn't match the hash
+        POST /flash                   {"serial", "image_hash", "link_address"}, flashes a stored image
+    """
+    def __init__(self, backend=None, host='localhost', port=DEFAULT_PORT, image_dir=None):
+        """
+        :param backend: LocalBackend (the default) or simulator.SimulatedBackend
+        :param port: port to listen on, 0 picks a free one
+        :param image_dir: where received images are kept, a temporary directory (removed by close()) by default
+        """
+        self.backend = backend or LocalBackend()
+        self._owns_image_dir = image_dir is None
+        self.image_dir = image_dir or tempfile.mkdtemp(prefix='agent-images-')
+        self.lock = threading.Lock()
+        self._discovering = threading.Lock()
+        self.boards = {}
+        self.busy = set()
+        self.discover()
+
+        self.server = ThreadingHTTPServer((host, port), _AgentHandler)
+        self.server.agent = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """
+        Starts serving requests in the background
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._owns_image_dir:
+            shutil.rmtree(self.image_dir, ignore_errors=True)
+
+    def list_boards(self):
+        """
+        :return: list of (ProbeRecord, busy) for the probes found by the last discover()
+        """
+        with self.lock:
+            return [(record, serial in self.busy) for serial, record in self.boards.items()]
+
+    def discover(self):
+        """
+        Probes for attached boards again. Boards being flashed keep their records, they are neither probed
+        nor dropped.
+        :return: see list_boards()
+        """
+        with self._discovering:
+            with self.lock:
+                busy = set(self.busy)
+            records = self.backend.discover(busy)
+
+            with self.lock:
+                boards = {record.serial: record for record in records}
+                # Boards that started flashing while discovery ran keep the record they were placed with
+                boards.update({serial: self.boards[serial] for serial in self.busy if serial in self.boards})
+                self.boards = boards
+
+        return self.list_boards()
+
+    def image_path(self, image_hash):
+        return os.path.join(self.image_dir, "%s.bin" % image_hash)
+
+    def store_image(self, image_hash, stream, length):
+        """
+        Saves an image received from the coordinator
+        :return: True if it was stored, False if its content didn't match image_hash
+        """
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.image_dir, delete=False) as file:
+            while length > 0:
+                block = stream.read(min(BLOCK_SIZE, length))
+                if not block:
+                    break
+                digest.update(block)
+                file.write(block)
+                length -= len(block)
+
+        if length or digest.hexdigest() != image_hash:
+            os.remove(file.name)
+            return False
+
+        os.replace(file.name, self.image_path(image_hash))
+        return True
+
+    def flash(self, serial, image_hash, link_address="0x08000000"):
+        """
+        Flashes a stored image onto one of this host's boards
+        :return: seconds taken
+        """
+        with self.lock:
+            if serial not in self.boards:
+                raise KeyError("No board with serial %s on this host" % serial)
+            if serial in self.busy:
+                raise RuntimeError("Board %s is busy" % serial)
+            self.busy.add(serial)
+
+        try:
+            start = time.perf_counter()
+            self.backend.flash(serial, self.image_path(image_hash), link_address)
+            return time.perf_counter() - start
+        finally:
+            with self.lock:
+                self.busy.discard(serial)
+
+
+class _AgentHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _image_hash(self):
+        prefix = '/images/'
+        if not self.path.startswith(prefix):
+            return None
+        image_hash = self.path[len(prefix):]
+        return image_hash if _is_image_hash(image_hash) else None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/boards':
+            return self._reply(404, {'error': "Unknown path %s" % self.path})
+
+        agent = self.server.agent
+        refresh = urllib.parse.parse_qs(url.query).get('refresh', ['0'])[0] not in ('0', 'false')
+        boards = [dict(record.to_dict(), busy=busy)
+                  for record, busy in (agent.discover() if refresh else agent.list_boards())]
+        self._reply(200, boards)
+
+    def do_HEAD(self):
+        image_hash = self._image_hash()
+        found = image_hash is not None and os.path.exists(self.server.agent.image_path(image_hash))
+        self._reply(200 if found else 404)
+
+    def do_PUT(self):
+        image_hash = self._image_hash()
+        if image_hash is None:
+            return self._reply(404, {'error': "Unknown path %s" % self.path})
+
+        if not self.server.agent.store_image(image_hash, self.rfile, int(self.headers.get('Content-Length', 0))):
+            return self._reply(400, {'error': "Image content does not match %s" % image_hash})
+        self._reply(201, {})
+
+    def do_POST(self):
+        if self.path != '/flash':
+            return self._reply(404, {'error': "Unknown path %s" % self.path})
+
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if not _is_image_hash(request.get('image_hash')):
+            return self._reply(400, {'error': "Invalid image hash %r" % request.get('image_hash')})
+
+        agent = self.server.agent
+        if not os.path.exists(agent.image_path(request['image_hash'])):
+            return self._reply(404, {'error': "Image %s has not been sent to this host" % request['image_hash']})
+
+        try:
+            seconds = agent.flash(request['serial'], request['image_hash'], request.get('link_address', "0x08000000"))
+        except KeyError as error:
+            return self._reply(404, {'error': str(error.args[0])})
+        except FlashError as error:
+            return self._reply(500, {'error': str(error), 'failure': error.failure, 'output': error.output,
+                                     'offset': error.offset})
+        except Exception as error:
+            return self._reply(500, {'error': str(error), 'failure': UNKNOWN})
+
+        self._reply(200, {'seconds': seconds})
+
+
+def _request(method, url, body=None, data=None, headers=None, timeout=COMMAND_TIMEOUT):
+    """
+    Sends a request to an agent
+    :param body: JSON body
+    :param data: raw body, bytes or a file
+    :return: (status, decoded JSON reply or None)
+    """
+    headers = dict(headers or {})
+    if body is not None:
+        data = json.dumps(body).encode("utf-8")
+        headers['Content-Type'] = 'application/json'
+
+    request = urllib.request.Request(url, data=data, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, reply = response.status, response.read()
+    except urllib.error.HTTPError as error:
+        status, reply = error.code, error.read()
+
+    return status, json.loads(reply) if reply else None
+
+
+class Coordinator:
+    """
+    Flashes boards spread over several hosts, each running an Agent. The coordinator keeps an inventory of
+    every agent's boards and places each job on an idle board with a matching chip, on whichever host has
+    the fewest jobs running. Images are identified by content hash and sent to each host at most once.
+    """
+    def __init__(self, agent_urls, board_inventory=None):
+        """
+        :param agent_urls: base URLs of the agents, eg 'http://rack2:8700'
+        :param board_inventory: inventory.Inventory to keep up to date, an in memory one is used if not given
+        """
+        self.agents = [url.rstrip('/') for url in agent_urls]
+        self.inventory = board_inventory or inventory.Inventory(':memory:')
+        self.condition = threading.Condition()
+
+        self.hosts = {}                                 # serial -> agent url
+        self.load = {url: 0 for url in self.agents}     # agent url -> jobs running
+        self.images = {url: set() for url in self.agents}
+
+        self._hashes = {}           # binary file -> (mtime, size, hash)
+        self._transfers = {}        # (agent url, hash) -> Lock held while the image is being sent
+
+    def refresh(self, rediscover=False):
+        """
+        Fetches every agent's boards. Boards of agents that can't be reached are marked as detached.
+        :param rediscover: have the agents probe for their boards again, rather than report the ones they know
+        :return: number of boards found
+        """
+        records = []
+        hosts = {}
+        for url in self.agents:
+            try:
+                _, boards = _request('GET', url + ('/boards?refresh=1' if rediscover else '/boards'))
+            except OSError as error:
+                print("Agent %s is unreachable: %s" % (url, error))
+                continue
+
+            for board in boards:
+                record = ProbeRecord.from_dict(board)
+                records.append(record)
+                hosts[record.serial] = url
+
+        with self.condition:
+            self.hosts = hosts
+            self.inventory.sync_records(records)
+            self.condition.notify_all()
+
+        return len(records)
+
+    def run(self, job):
+        """
+        Flashes a job, waiting for a matching board to become free if they are all busy
+        :param job: prestage.Job to run
+        :return: dict of serial, host, image_hash and seconds
+        """
+        digest = self._image_hash(job.binary_file)
+        with self.condition:
+            placement = None
+            while placement is None:
+                # refresh() wakes waiting jobs, and may have found every matching board detached
+                if not self.inventory.find(chip_id=job.chip_id, attached=True):
+                    raise ValueError("No attached board has chip id 0x%x." % job.chip_id)
+
+                placement = self._place(job)
+                if placement is None:
+                    self.condition.wait()
+        record, url = placement
+
+        try:
+            self._send_image(url, job.binary_file, digest)
+            status, reply = _request('POST', url + '/flash', {'serial': record.serial, 'image_hash': digest,
+                                                              'link_address': job.link_address})
+            if status != 200:
+                reply = reply or {}
+                raise FlashError("Failed flashing %s onto board %s on %s: %s" %
+                                 (job.binary_file, record.serial, url, reply.get('error')),
+                                 reply.get('failure', UNKNOWN), reply.get('output', ''), reply.get('offset'))
+
+            self.inventory.mark_flashed(record.serial, digest)
+        finally:
+            with self.condition:
+                self.load[url] -= 1
+                self.inventory.set_state(record.serial, inventory.IDLE)
+                self.condition.notify_all()
+
+        return {'serial': record.serial, 'host': url, 'image_hash': digest, 'seconds': reply['seconds']}
+
+    def run_all(self, jobs):
+        """
+        Runs a batch of jobs in parallel
+        :return: list with each job's run() result, or the exception it raised, in job order
+        """
+        if not jobs:
+            return []
+
+        def run_one(job):
+            try:
+                return self.run(job)
+            except Exception as error:
+                return error
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as workers:
+            return list(workers.map(run_one, jobs))
+
+    def _place(self, job):
+        # Called with the condition held
+        boards = [record for record in self.inventory.find(chip_id=job.chip_id, attached=True, state=inventory.IDLE)
+                  if record.serial in self.hosts]
+        if not boards:
+            return None
+
+        record = min(boards, key=lambda record: self.load[self.hosts[record.serial]])
+        url = self.hosts[record.serial]
+        self.load[url] += 1
+        self.inventory.set_state(record.serial, inventory.BUSY)
+        return record, url
+
+    def _image_hash(self, binary_file):
+        stat = os.stat(binary_file)
+        cached = self._hashes.get(binary_file)
+        if cached is None or cached[:2] != (stat.st_mtime, stat.st_size):
+            cached = (stat.st_mtime, stat.st_size, image_hash(binary_file))
+            self._hashes[binary_file] = cached
+        return cached[2]
+
+    def _send_image(self, url, binary_file, digest):
+        with self.condition:
+            lock = self._transfers.setdefault((url, digest), threading.Lock())
+
+        # Jobs for the same image on the same host wait for one transfer instead of each sending it
+        with lock:
+            if digest in self.images[url]:
+                return
+
+            image_url = "%s/images/%s" % (url, digest)
+            status, _ = _request('HEAD', image_url)
+            if status != 200:
+                with open(binary_file, 'rb') as file:
+                    status, reply = _request('PUT', image_url, data=file,
+                                             headers={'Content-Length': str(os.path.getsize(binary_file))})
+                if status != 201:
+                    raise RuntimeError("Failed sending %s to %s: %s" % (binary_file, url, (reply or {}).get('error')))
+
+            self.images[url].add(digest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flashes boards spread over several rack hosts.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    agent = commands.add_parser('agent', help="serve this host's probes")
+    agent.add_argument('--host', default='0.0.0.0', help="address to listen on")
+    agent.add_argument('--port', type=int, default=DEFAULT_PORT, help="port to listen on")
+    agent.add_argument('--image-dir', help="where received images are kept")
+    agent.add_argument('--simulated', type=int, default=0, help="serve this many simulated probes instead")
+    agent.add_argument('--chip-id', type=lambda value: int(value, 16), default=0x451,
+                       help="chip id of the simulated probes")
+
+    flash = commands.add_parser('flash', help="flash an image onto boards through agents")
+    flash.add_argument('--agent', action='append', required=True, help="agent URL, can be given several times")
+    flash.add_argument('--chip-id', type=lambda value: int(value, 16), required=True, help="chip id to flash")
+    flash.add_argument('--link-address', default="0x08000000", help="program flash link address")
+    flash.add_argument('--count', type=int, default=1, help="number of boards to flash")
+    flash.add_argument('binary_file', help="binary to flash")
+
+    arguments = parser.parse_args()
+
+    if arguments.command == 'agent':
+        backend = None
+        if arguments.simulated:
+            from simulator import SimulatedBackend, SimulatedProbe
+            backend = SimulatedBackend([SimulatedProbe(arguments.port * 1000 + index, arguments.chip_id)
+                                        for index in range(arguments.simulated)])
+
+        server = Agent(backend, arguments.host, arguments.port, arguments.image_dir)
+        print("Serving %d board(s) on %s" % (len(server.boards), server.url))
+        try:
+            server.server.serve_forever()
+        except KeyboardInterrupt:
+            server.close()
+    else:
+        coordinator = Coordinator(arguments.agent)
+        print("Found %d board(s)." % coordinator.refresh())
+
+        jobs = [Job(os.path.abspath(arguments.binary_file), arguments.chip_id, arguments.link_address)
+                for _ in range(arguments.count)]
+        for result in coordinator.run_all(jobs):
+            if isinstance(result, Exception):
+                print("Failed: %s" % result)
+            else:
+                print("Flashed board %(serial)s on %(host)s in %(seconds).2f s" % result)
+
+
+if __name__ == "__main__":
+    main()
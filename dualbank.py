@@ -0,0 +1,208 @@
+import os
+import re
+import struct
+
+from openocd import OpenOCDSession
+from stlink import FLASH_BASE, flash_changed
+from tools import FlashError
+
+
+# STM32F76x/F77x flash interface registers (RM0410)
+FLASH_KEYR = 0x40023C04
+FLASH_OPTKEYR = 0x40023C08
+FLASH_SR = 0x40023C0C
+FLASH_CR = 0x40023C10
+FLASH_OPTCR = 0x40023C14
+FLASH_OPTCR1 = 0x40023C18
+
+FLASH_KEYS = (0x45670123, 0xCDEF89AB)
+FLASH_OPTKEYS = (0x08192A3B, 0x4C5D6E7F)
+
+SR_BSY = 1 << 16
+SR_ERRORS = 0xF2            # OPERR, WRPERR, PGAERR, PGPERR, ERSERR
+CR_PG = 1 << 0
+CR_SER = 1 << 1
+CR_PSIZE_X32 = 2 << 8
+CR_STRT = 1 << 16
+CR_LOCK = 1 << 31
+SNB_BANK2 = 1 << 4
+OPTCR_OPTLOCK = 1 << 0
+OPTCR_OPTSTRT = 1 << 1
+OPTCR_NDBOOT = 1 << 28
+OPTCR_NDBANK = 1 << 29
+
+# Chip id of the STM32F76x/F77x, the only parts with dual bank support
+DUAL_BANK_CHIP_ID = 0x451
+
+
+class DualBankUpdater:
+    """
+    Background updates for STM32F76x/F77x parts running in dual bank mode (nDBANK = 0). The new image is
+    programmed into the bank the device is not booting from while the application keeps running from the
+    other one. The flash is programmed through its registers over SWD, which works with the core running
+    thanks to the read-while-write support between banks. Once the new image is verified, the boot address
+    (BOOT_ADD0) is pointed at it with one option byte change and the device is reset, so the only downtime
+    is that reset. If anything fails before the switch, the old image is still the one that boots.
+
+    There is no bank swap aliasing on these parts, so each image must be linked for the bank it runs from.
+    """
+    def __init__(self, stlink, session=None):
+        if stlink.stlink.chip_id != DUAL_BANK_CHIP_ID:
+            raise ValueError("Dual bank updates need an STM32F76x/F77x, device %s has chip id 0x%x." %
+                             (stlink.stlink.name, stlink.stlink.chip_id))
+
+        self.stlink = stlink
+        self.session = session or OpenOCDSession(stlink.stlink)
+        self._owns_session = session is None
+
+        self.bank_size = stlink.stlink.attached_device.flash // 2
+        self.banks = (FLASH_BASE, FLASH_BASE + self.bank_size)
+
+        # In dual bank mode every single bank sector is split in two
+        self.bank_sectors = []
+        offset = 0
+        for _, sector_size in stlink.sectors:
+            if offset >= self.bank_size:
+                break
+            self.bank_sectors.append((offset, sector_size // 2))
+            offset += sector_size // 2
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._owns_session:
+            self.session.close()
+
+    @property
+    def dual_bank_enabled(self):
+        return not self._read(FLASH_OPTCR) & OPTCR_NDBANK
+
+    @property
+    def boot_address(self):
+        """
+        The address the device boots from (BOOT_ADD0, used when the BOOT pin is low)
+        """
+        return (self._read(FLASH_OPTCR1) & 0xFFFF) << 14
+
+    @property
+    def active_bank(self):
+        """
+        :return: 0 or 1, the bank the device currently boots from
+        """
+        return 1 if self.boot_address >= self.banks[1] else 0
+
+    @property
+    def inactive_bank_address(self):
+        """
+        The address images for the next update must be linked for
+        """
+        return self.banks[1 - self.active_bank]
+
+    def enable_dual_bank(self):
+        """
+        Switches the part into dual bank mode with dual boot enabled. This changes the flash sector layout,
+        so the device must be fully re-flashed afterwards (a mass erase is performed here).
+        """
+        flash_changed(self.stlink.stlink.serial_number)
+        self.session.command("reset halt")
+        self._write_option_bytes(FLASH_OPTCR, self._read(FLASH_OPTCR) & ~(OPTCR_NDBANK | OPTCR_NDBOOT))
+        self.session.command("reset halt")
+        self.session.command("stm32f2x mass_erase 0", "Failed mass erasing device %s" % self.stlink.stlink.name)
+
+    def update(self, binary_file):
+        """
+        Programs an image into the inactive bank, verifies it and switches the device over to it
+        :param binary_file: absolute path to the binary, linked for inactive_bank_address
+        :return: the bank now being booted from
+        """
+        if not self.dual_bank_enabled:
+            raise RuntimeError("Device %s is not in dual bank mode, see enable_dual_bank()." %
+                               self.stlink.stlink.name)
+
+        bank = 1 - self.active_bank
+        bank_address = self.banks[bank]
+        image_size = os.path.getsize(binary_file)
+
+        if image_size > self.bank_size:
+            raise ValueError("%s is %d bytes, too large for a %d byte bank." % (binary_file, image_size,
+                                                                                self.bank_size))
+
+        with open(binary_file, 'rb') as file:
+            _, reset_handler = struct.unpack('<II', file.read(8))
+        if not bank_address <= reset_handler < bank_address + image_size:
+            raise ValueError("%s is not linked for bank %d at 0x%08x." % (binary_file, bank + 1, bank_address))
+
+        flash_changed(self.stlink.stlink.serial_number)
+        self._unlock(FLASH_KEYR, FLASH_KEYS)
+        try:
+            for index, (offset, _) in enumerate(self.bank_sectors):
+                if offset >= image_size:
+                    break
+                # In dual bank mode, bank 2 sectors are numbered from 0x10 (RM0410 FLASH_CR.SNB)
+                self._erase_sector(SNB_BANK2 | index if bank else index)
+
+            self.session.command("mww 0x%08x 0x%08x" % (FLASH_CR, CR_PG | CR_PSIZE_X32))
+            self.session.command("load_image {%s} 0x%08x bin" % (binary_file, bank_address),
+                                 "Failed programming bank %d of device %s" % (bank + 1, self.stlink.stlink.name))
+            self._wait_ready()
+        finally:
+            self.session.command("mww 0x%08x 0x%08x" % (FLASH_CR, CR_LOCK))
+
+        self.session.command("verify_image {%s} 0x%08x bin" % (binary_file, bank_address),
+                             "Verification of bank %d failed on device %s" % (bank + 1, self.stlink.stlink.name))
+
+        # Point BOOT_ADD0 at the new image and reset into it
+        boot_add0 = bank_address >> 14
+        self._write_option_bytes(FLASH_OPTCR1, (self._read(FLASH_OPTCR1) & 0xFFFF0000) | boot_add0)
+        self.session.command("reset run", "Failed resetting device %s" % self.stlink.stlink.name)
+
+        return bank
+
+    def _read(self, address):
+        result = self.session.command("mdw 0x%08x" % address)
+        match = re.search(r"0x[0-9a-f]+:\s*([0-9a-f]+)", result, re.I)
+        if not match:
+            raise RuntimeError("Could not read 0x%08x from device %s: %s" % (address, self.stlink.stlink.name,
+                                                                              result))
+        return int(match.group(1), 16)
+
+    def _unlock(self, key_register, keys):
+        # Writing the keys to an already unlocked register locks it until the next reset
+        if key_register == FLASH_KEYR and not self._read(FLASH_CR) & CR_LOCK:
+            return
+        if key_register == FLASH_OPTKEYR and not self._read(FLASH_OPTCR) & OPTCR_OPTLOCK:
+            return
+
+        for key in keys:
+            self.session.command("mww 0x%08x 0x%08x" % (key_register, key))
+
+    def _wait_ready(self):
+        # Runs inside OpenOCD so the busy flag is not polled across the TCL connection
+        self.session.command("while {[expr {[mrw 0x%08x] & 0x%x}]} {sleep 1}" % (FLASH_SR, SR_BSY))
+
+        status = self._read(FLASH_SR)
+        if status & SR_ERRORS:
+            self.session.command("mww 0x%08x 0x%08x" % (FLASH_SR, SR_ERRORS))
+            raise FlashError("Flash error 0x%02x on device %s" % (status & SR_ERRORS, self.stlink.stlink.name))
+
+    def _erase_sector(self, sector):
+        self.session.command("mww 0x%08x 0x%08x" % (FLASH_CR, CR_SER | (sector << 3) | CR_PSIZE_X32))
+        self.session.command("mww 0x%08x 0x%08x" % (FLASH_CR, CR_SER | (sector << 3) | CR_PSIZE_X32 | CR_STRT))
+        self._wait_ready()
+
+    def _write_option_bytes(self, register, value):
+        if register == FLASH_OPTCR:
+            # Don't re-lock or start the change while writing the new value
+            value &= ~(OPTCR_OPTLOCK | OPTCR_OPTSTRT)
+
+        self._unlock(FLASH_OPTKEYR, FLASH_OPTKEYS)
+        try:
+            self.session.command("mww 0x%08x 0x%08x" % (register, value))
+            self.session.command("mmw 0x%08x 0x%08x 0" % (FLASH_OPTCR, OPTCR_OPTSTRT))
+            self._wait_ready()
+        finally:
+            self.session.command("mmw 0x%08x 0x%08x 0" % (FLASH_OPTCR, OPTCR_OPTLOCK))
@@ -2,16 +2,23 @@ import sys
 import os
 import subprocess
 
+from performance import FLASH, HOST, timed
+from stlink import flash_changed
+from tools import FlashError, classify_failure, run_command
+
 error = 'Couldn\'t find any ST-Link/V2 devices'
 
 stm32f7_binary_dir = 'TestBinaries/STM32F7xxx'
 
 
 class STM32BinaryFlasher():
-    def __init__(self, binaries_dir):
+    def __init__(self, binaries_dir, history=None):
         self.binary_root = binaries_dir
         self.device = {}
 
+        # Optional performance.PerformanceHistory that flash times are recorded in
+        self.history = history
+
         self.no_dev_err = 'Found 0 stlink programmers\n'
 
         self.supported_devices = \
@@ -45,6 +52,10 @@ class STM32BinaryFlasher():
         string = probe_data[self._index_of_substring(probe_data, 'chipid')].split(" ")
         self.device["chip_id"] = int(string[1], 16)
 
+        # Grab the serial, so timings can be kept per board
+        string = probe_data[self._index_of_substring(probe_data, 'serial')].split(" ")
+        self.device["serial"] = int(string[1])
+
     def check_connection(self, expected_device):
         if expected_device not in self.supported_devices.keys():
             print("Unrecognized device type, exiting.")
@@ -64,14 +75,30 @@ class STM32BinaryFlasher():
             print("Successfully connected to an " + expected_device)
             return True
 
-    def flash_device(self, binary_file, address):
-        flash_cmd = " ".join(["st-flash write", os.path.join(self.binary_root, binary_file), address]) 
+    def flash_device(self, binary_file, address, freq=None, operation=FLASH):
+        flash_cmd = "st-flash"
+        if freq:
+            # SWD clock in kHz, see tuning.FlashTuner for finding the best one for a probe
+            flash_cmd += " --freq=%dk" % freq
 
-        print(flash_cmd)
-        output = subprocess.run(flash_cmd, shell=True)
+        binary_path = os.path.join(self.binary_root, binary_file)
+        flash_cmd = " ".join([flash_cmd, "write", binary_path, address])
+
+        image_size = os.path.getsize(binary_path) if os.path.exists(binary_path) else None
 
-        if output.returncode != 0:
-            raise RuntimeError("Failed flashing \'" + binary_file + "\' at location \'" + address + "\'")
+        print(flash_cmd)
+        if "serial" in self.device:
+            flash_changed(self.device["serial"])
+        # operation is what the timing is recorded as, see performance.TUNE
+        with timed(self.history, operation, serial=self.device.get("serial", HOST), chip_id=self.device.get("chip_id"),
+                   image_size=image_size):
+            output = run_command(flash_cmd, shell=True, echo=True)
+            text = output.stdout.decode("utf-8", "replace")
+
+            if output.returncode != 0:
+                # FlashError is a RuntimeError that also says why st-flash failed (see recovery.RecoveryEngine)
+                raise FlashError("Failed flashing \'" + binary_file + "\' at location \'" + address + "\'",
+                                 classify_failure(text.strip()), text)
 
 if __name__ == "__main__":
     flasher = STM32BinaryFlasher(stm32f7_binary_dir)
@@ -0,0 +1,195 @@
+import json
+import time
+import sqlite3
+import threading
+
+from records import ProbeRecord
+from stm32devices import part_family
+
+
+IDLE = 'idle'
+BUSY = 'busy'
+
+
+class Inventory:
+    """
+    A local SQLite backed record of every STLink probe that has been seen, indexed so that boards can be
+    selected by serial, chip id, part family, USB port or the hash of the last image flashed to them.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS boards (
+            serial          TEXT PRIMARY KEY,
+            name            TEXT,
+            chip_id         INTEGER NOT NULL,
+            family          TEXT,
+            usb_port        TEXT,
+            attached        INTEGER NOT NULL DEFAULT 0,
+            state           TEXT NOT NULL DEFAULT 'idle',
+            last_image_hash TEXT,
+            last_seen       REAL,
+            last_flashed    REAL,
+            record          BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS boards_chip_id ON boards (chip_id);
+        CREATE INDEX IF NOT EXISTS boards_usb_port ON boards (usb_port);
+        CREATE INDEX IF NOT EXISTS boards_image_hash ON boards (last_image_hash);
+        CREATE INDEX IF NOT EXISTS boards_availability ON boards (family, attached, state);
+    """
+
+    def __init__(self, filename='inventory.db'):
+        # Shared by the threads driving boards (see prestage.PreStager and distributed.Coordinator). SQLite
+        # connections aren't safe to use from several threads at once, so every access holds the lock.
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.connection.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def add_probe(self, record, attached=True):
+        """
+        Adds or updates a probe in the inventory. The board's state and flash history are kept.
+        :param record: ProbeRecord of the probe
+        :param attached: whether the probe is currently plugged into this host
+        """
+        with self.lock, self.connection:
+            self._upsert(record, attached)
+
+    def sync(self, usb_interface):
+        """
+        Updates the inventory with the devices found by an STLink_USBInterface. Anything not in its
+        found_devices list is marked as detached.
+        :param usb_interface: STLink_USBInterface that has already run discover_devices()
+        """
+        self.sync_records(usb_interface.found_devices)
+
+    def sync_records(self, records):
+        """
+        Updates the inventory with the complete list of attached probes, anything else is marked as detached
+        :param records: ProbeRecords of every attached probe
+        """
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE boards SET attached = 0")
+            for record in records:
+                self._upsert(record, attached=True)
+
+    def import_json(self, filenames):
+        """
+        Bulk imports device files written by STLink_USBInterface.save_device(). New boards are marked as
+        detached until they are seen by sync(). Boards already in the inventory only pick up a name from the
+        file if they don't have one, the files are older than what sync() and add_probe() record.
+        :param filenames: iterable of .json file locations
+        :return: number of boards imported
+        """
+        count = 0
+        with self.lock, self.connection:
+            for filename in filenames:
+                if not filename.endswith(".json"):
+                    raise ValueError("Cannot import %s. Expected a .json extension." % filename)
+
+                with open(filename) as file:
+                    self._import(ProbeRecord.from_dict(json.loads(file.read())))
+                count += 1
+
+        return count
+
+    def set_state(self, serial, state):
+        """
+        Marks a board as idle or busy
+        :param serial: serial number of the probe
+        :param state: IDLE or BUSY
+        """
+        if state not in (IDLE, BUSY):
+            raise ValueError("Unknown board state '%s'" % state)
+
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE boards SET state = ? WHERE serial = ?", (state, str(serial)))
+
+    def mark_flashed(self, serial, image_hash):
+        """
+        Records the image that was last flashed onto a board
+        :param serial: serial number of the probe
+        :param image_hash: content hash of the flashed image
+        """
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE boards SET last_image_hash = ?, last_flashed = ? WHERE serial = ?",
+                                    (image_hash, time.time(), str(serial)))
+
+    def get(self, serial):
+        """
+        :return: the ProbeRecord for a serial number, or None if it has never been seen
+        """
+        results = self.find(serial=serial)
+        return results[0] if results else None
+
+    def find(self, serial=None, chip_id=None, family=None, usb_port=None, image_hash=None, attached=None,
+             state=None):
+        """
+        Queries the inventory. Every given argument must match.
+        :return: list of ProbeRecord
+        """
+        criteria = [('serial', None if serial is None else str(serial)),
+                    ('chip_id', chip_id),
+                    ('family', family),
+                    ('usb_port', usb_port),
+                    ('last_image_hash', image_hash),
+                    ('attached', None if attached is None else int(attached)),
+                    ('state', state)]
+        criteria = [(column, value) for column, value in criteria if value is not None]
+
+        query = "SELECT record, name FROM boards"
+        if criteria:
+            query += " WHERE " + " AND ".join("%s = ?" % column for column, _ in criteria)
+
+        with self.lock:
+            rows = self.connection.execute(query, [value for _, value in criteria]).fetchall()
+
+        records = []
+        for packed, name in rows:
+            record = ProbeRecord.unpack(packed)
+            record.name = name
+            records.append(record)
+
+        return records
+
+    def available(self, family):
+        """
+        Gets all boards of a part family that are currently attached and idle
+        :param family: part family, eg 'F7'
+        """
+        return self.find(family=family, attached=True, state=IDLE)
+
+    def _import(self, record):
+        self.connection.execute(
+            """
+            INSERT INTO boards (serial, name, chip_id, family, usb_port, attached, record)
+            VALUES (?, ?, ?, ?, ?, 0, ?)
+            ON CONFLICT (serial) DO UPDATE SET
+                name = COALESCE(boards.name, excluded.name)
+            """,
+            (str(record.serial), record.name, record.chipid, part_family(record.chipid, record.descr),
+             record.usb_port, record.pack()))
+
+    def _upsert(self, record, attached):
+        self.connection.execute(
+            """
+            INSERT INTO boards (serial, name, chip_id, family, usb_port, attached, last_seen, record)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (serial) DO UPDATE SET
+                name = COALESCE(excluded.name, boards.name),
+                chip_id = excluded.chip_id,
+                family = excluded.family,
+                usb_port = excluded.usb_port,
+                attached = excluded.attached,
+                last_seen = CASE WHEN excluded.attached THEN excluded.last_seen ELSE boards.last_seen END,
+                record = excluded.record
+            """,
+            (str(record.serial), record.name, record.chipid, part_family(record.chipid, record.descr),
+             record.usb_port, int(attached), time.time() if attached else None, record.pack()))
@@ -0,0 +1,140 @@
+import time
+import socket
+import tempfile
+import subprocess
+import threading
+
+from stm32devices import part_family
+from tools import COMMAND_TIMEOUT, PROBE_LOST, FlashError, classify_failure
+
+
+# OpenOCD target configurations for each part family
+OPENOCD_TARGETS = {
+    'F0': 'target/stm32f0x.cfg',
+    'F1': 'target/stm32f1x.cfg',
+    'F2': 'target/stm32f2x.cfg',
+    'F3': 'target/stm32f3x.cfg',
+    'F4': 'target/stm32f4x.cfg',
+    'F7': 'target/stm32f7x.cfg',
+    'L0': 'target/stm32l0.cfg',
+    'L1': 'target/stm32l1.cfg',
+}
+
+
+def openocd_arguments(usb_dev):
+    """
+    Builds the OpenOCD command line that selects the probe attached to an STLink_USBInterface
+    :param usb_dev: STLink_USBInterface with an attached device
+    :return: argument list, further "-c" commands can be appended
+    """
+    device = usb_dev.attached_device
+
+    family = part_family(device.chipid, device.descr)
+    if family not in OPENOCD_TARGETS:
+        raise ValueError("No OpenOCD target configuration for part family %s." % family)
+
+    # The probe reports its serial as hex encoded ASCII
+    serial = bytes.fromhex(device.openocd).decode("ascii", "replace")
+
+    return ["openocd",
+            "-f", "interface/stlink.cfg",
+            "-c", "adapter serial %s" % serial,
+            "-f", OPENOCD_TARGETS[family]]
+
+
+def free_port():
+    """
+    Gets a free localhost TCP port for one of OpenOCD's servers
+    """
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class OpenOCDSession:
+    """
+    A long running OpenOCD process attached to one probe, driven over its TCL RPC port. Keeping the
+    session open avoids reconnecting to the target for every command. Commands from several threads are
+    serialized, since they all share the one SWD link.
+    """
+    TERMINATOR = b'\x1a'
+
+    def __init__(self, usb_dev, tcl_port=None, startup_timeout=10):
+        self.name = usb_dev.name
+        self.tcl_port = tcl_port or free_port()
+        self.lock = threading.Lock()
+
+        # OpenOCD logs every command, so its output goes to a file rather than a pipe nobody drains
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(openocd_arguments(usb_dev) +
+                                        ["-c", "tcl_port %d" % self.tcl_port,
+                                         "-c", "gdb_port disabled",
+                                         "-c", "telnet_port disabled",
+                                         "-c", "init"],
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+        self.socket = None
+        deadline = time.monotonic() + startup_timeout
+        while self.socket is None:
+            if self.process.poll() is not None:
+                self.log.seek(0)
+                output = self.log.read().decode("utf-8", "replace")
+                raise FlashError("OpenOCD exited while connecting to device %s" % self.name,
+                                 classify_failure(output), output)
+            try:
+                self.socket = socket.create_connection(('localhost', self.tcl_port), timeout=COMMAND_TIMEOUT)
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.close()
+                    raise FlashError("Timed out connecting to OpenOCD for device %s" % self.name)
+                time.sleep(0.1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def command(self, command, message=None):
+        """
+        Runs a single OpenOCD command. Raises FlashError if it fails.
+        :param command: the command, eg "reset halt"
+        :param message: the FlashError message used if the command fails
+        :return: the command's result as a string
+        """
+        # Wrap the command so errors come back as a status code instead of an empty reply
+        wrapped = 'format "%%d %%s" [catch {%s} _result] $_result' % command
+
+        with self.lock:
+            self.socket.sendall(wrapped.encode("utf-8") + self.TERMINATOR)
+
+            reply = b''
+            while not reply.endswith(self.TERMINATOR):
+                chunk = self.socket.recv(4096)
+                if not chunk:
+                    raise FlashError("OpenOCD closed the connection to device %s" % self.name,
+                                     PROBE_LOST)
+                reply += chunk
+
+        status, _, result = reply[:-1].decode("utf-8", "replace").partition(' ')
+        if status != '0':
+            raise FlashError(message or "OpenOCD command '%s' failed" % command, classify_failure(result), result)
+
+        return result
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.sendall(b'shutdown' + self.TERMINATOR)
+            except OSError:
+                pass
+            self.socket.close()
+            self.socket = None
+
+        if self.process.poll() is None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+        self.log.close()
@@ -0,0 +1,216 @@
+import time
+import sqlite3
+import threading
+import argparse
+import statistics
+from contextlib import contextmanager
+
+
+# Operations
+FLASH = 'flash'
+DISCOVER = 'discover'
+TUNE = 'tune'           # FlashTuner's sweeps, deliberately slow at times so kept apart from FLASH
+
+# Serial used for operations that are not tied to one probe, like discovery
+HOST = 'host'
+
+
+class Regression:
+    """
+    A board whose recent runs of an operation are significantly slower than its own baseline
+    """
+    __slots__ = ('serial', 'chip_id', 'operation', 'baseline', 'recent', 'ratio')
+
+    def __init__(self, serial, chip_id, operation, baseline, recent):
+        self.serial = serial
+        self.chip_id = chip_id
+        self.operation = operation
+        self.baseline = baseline
+        self.recent = recent
+        self.ratio = recent / baseline
+
+    def __repr__(self):
+        return "Regression(%s, %s, %.0f%% of baseline)" % (self.serial, self.operation, 100 * self.ratio)
+
+
+class PerformanceHistory:
+    """
+    A local SQLite time series of how long operations took on each board. Operations that move an image
+    are compared by throughput (image_size / seconds), everything else by rate (1 / seconds), so a higher
+    value is always better.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS timings (
+            time        REAL NOT NULL,
+            operation   TEXT NOT NULL,
+            serial      TEXT NOT NULL,
+            chip_id     INTEGER,
+            image_size  INTEGER,
+            seconds     REAL NOT NULL,
+            success     INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS timings_board ON timings (operation, serial, time);
+        CREATE INDEX IF NOT EXISTS timings_time ON timings (time);
+    """
+
+    def __init__(self, filename='performance.db'):
+        # Flashes on several threads record into the one connection, which SQLite doesn't allow at once
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.connection.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def record(self, operation, seconds, serial=HOST, chip_id=None, image_size=None, success=True, timestamp=None):
+        """
+        Adds one timing
+        :param operation: FLASH, DISCOVER or any other operation name
+        :param seconds: how long it took
+        :param serial: serial number of the probe, HOST for operations not tied to one
+        :param image_size: bytes written, for operations that move an image
+        :param timestamp: when it finished, defaults to now
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (time.time() if timestamp is None else timestamp, operation,
+                                     str(serial), chip_id, image_size, seconds, int(success)))
+
+    @contextmanager
+    def timed(self, operation, serial=HOST, chip_id=None, image_size=None):
+        """
+        Times the body of a with statement and records it, as failed if it raises
+        """
+        start = time.perf_counter()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            self.record(operation, time.perf_counter() - start, serial, chip_id, image_size, success)
+
+    def runs(self, operation, serial, limit=None, since=None):
+        """
+        :return: list of (time, value) for a board's successful runs of an operation, newest first
+        """
+        query = ("SELECT time, COALESCE(image_size, 1) / seconds FROM timings "
+                 "WHERE operation = ? AND serial = ? AND success = 1 AND seconds > 0")
+        parameters = [operation, str(serial)]
+        if since is not None:
+            query += " AND time >= ?"
+            parameters.append(since)
+
+        query += " ORDER BY time DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def regressions(self, operation=FLASH, recent=5, baseline=20, drop=0.25):
+        """
+        Finds boards that have slowed down. Each board's median over its last recent runs is compared with
+        its median over the baseline runs before those.
+        :param recent: number of latest runs to judge
+        :param baseline: number of runs before them that make up the baseline, at least recent are needed
+        :param drop: how much slower (as a fraction of the baseline) counts as a regression
+        :return: list of Regression, worst first
+        """
+        regressions = []
+        with self.lock:
+            boards = self.connection.execute("SELECT serial, MAX(chip_id) FROM timings WHERE operation = ? "
+                                             "GROUP BY serial", (operation,)).fetchall()
+
+        for serial, chip_id in boards:
+            values = [value for _, value in self.runs(operation, serial, recent + baseline)]
+            if len(values) < 2 * recent:
+                continue
+
+            regression = Regression(serial, chip_id, operation, statistics.median(values[recent:]),
+                                    statistics.median(values[:recent]))
+            if regression.ratio < 1 - drop:
+                regressions.append(regression)
+
+        return sorted(regressions, key=lambda regression: regression.ratio)
+
+    def slowest(self, operation=FLASH, limit=10, since=None):
+        """
+        Ranks boards by their aggregate throughput (or rate) over a period
+        :param since: only count runs after this timestamp, defaults to all of them
+        :return: list of (serial, chip_id, runs, failures, value), slowest first
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT serial, MAX(chip_id), SUM(success), SUM(1 - success), "
+                "       SUM(CASE WHEN success THEN COALESCE(image_size, 1) END) / "
+                "       SUM(CASE WHEN success THEN seconds END) AS value "
+                "FROM timings WHERE operation = ? AND time >= ? "
+                "GROUP BY serial HAVING value IS NOT NULL ORDER BY value LIMIT ?",
+                (operation, since or 0, limit)).fetchall()
+
+
+@contextmanager
+def timed(history, operation, **fields):
+    """
+    PerformanceHistory.timed(), or nothing if history is None, for callers where recording is optional
+    """
+    if history is None:
+        yield
+    else:
+        with history.timed(operation, **fields):
+            yield
+
+
+def _format_value(operation_has_size, value):
+    return "%.1f KB/s" % (value / 1024) if operation_has_size else "%.2f s" % (1 / value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports on recorded flash and discovery timings.")
+    parser.add_argument('--db', default='performance.db', help="performance database file")
+    parser.add_argument('--operation', default=FLASH, help="operation to report on, eg flash or discover")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    report = commands.add_parser('report', help="list the slowest probes")
+    report.add_argument('--limit', type=int, default=10, help="number of probes to list")
+    report.add_argument('--days', type=float, help="only count runs from the last few days")
+
+    regressions = commands.add_parser('regressions', help="list probes slower than their own baseline")
+    regressions.add_argument('--recent', type=int, default=5, help="number of latest runs to judge")
+    regressions.add_argument('--baseline', type=int, default=20, help="number of earlier runs to compare with")
+    regressions.add_argument('--drop', type=float, default=0.25, help="slowdown that counts as a regression")
+
+    arguments = parser.parse_args()
+
+    with PerformanceHistory(arguments.db) as history:
+        has_size = history.connection.execute("SELECT 1 FROM timings WHERE operation = ? AND image_size "
+                                              "IS NOT NULL LIMIT 1", (arguments.operation,)).fetchone()
+
+        if arguments.command == 'report':
+            since = time.time() - arguments.days * 86400 if arguments.days else None
+            print("%-24s %-8s %6s %8s %14s" % ("Serial", "Chip id", "Runs", "Failures", "Speed"))
+            for serial, chip_id, runs, failures, value in history.slowest(arguments.operation, arguments.limit,
+                                                                         since):
+                print("%-24s %-8s %6d %8d %14s" % (serial, "0x%03x" % chip_id if chip_id else "-", runs, failures,
+                                                   _format_value(has_size, value)))
+        else:
+            found = history.regressions(arguments.operation, arguments.recent, arguments.baseline, arguments.drop)
+            for regression in found:
+                print("%-24s %-8s %14s -> %14s (%.0f%%)" % (
+                    regression.serial, "0x%03x" % regression.chip_id if regression.chip_id else "-",
+                    _format_value(has_size, regression.baseline), _format_value(has_size, regression.recent),
+                    100 * regression.ratio))
+            if not found:
+                print("No regressions found.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import queue
+import tempfile
+import threading
+
+from openocd import OpenOCDSession
+from stlink import FLASH_BASE, flash_changed
+from tools import FlashError
+
+
+class PipelinedWriter:
+    """
+    Programs write plans sector by sector over a single OpenOCD session, with sector erases split out
+    into their own stage. The erase stage runs ahead of programming, so a sector is normally blank by the
+    time the programmer reaches it, and sectors can be erased in advance with pre_erase() while the board
+    sits idle. While the writer is open, OpenOCD owns the probe, so st-flash cannot be used on it.
+    """
+    def __init__(self, stlink, session=None):
+        self.stlink = stlink
+        self.sectors = stlink.sectors
+        self.session = session or OpenOCDSession(stlink.stlink)
+        self._owns_session = session is None
+
+        # sector index -> threading.Event set once the sector's erase has finished
+        self.erased = {}
+        # sector index -> FlashError raised while erasing it
+        self.errors = {}
+
+        self.lock = threading.Lock()
+        self.erase_queue = queue.Queue()
+        self.eraser = threading.Thread(target=self._erase_worker, daemon=True)
+        self.eraser.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.erase_queue.put(None)
+        self.eraser.join()
+
+        if self._owns_session:
+            self.session.close()
+
+    def sectors_for(self, writes):
+        """
+        Gets the indices of the sectors touched by a list of (offset, size) write regions
+        """
+        indices = []
+        for index, (sector_start, sector_size) in enumerate(self.sectors):
+            for offset, size in writes:
+                if offset < sector_start + sector_size and sector_start < offset + size:
+                    indices.append(index)
+                    break
+        return indices
+
+    @property
+    def prepared_sectors(self):
+        """
+        Indices of sectors that are erased (or being erased) and waiting to be programmed
+        """
+        with self.lock:
+            return sorted(self.erased)
+
+    def pre_erase(self, plan):
+        """
+        Starts erasing the sectors a plan will write, in the background. Returns immediately. This destroys
+        whatever the board is currently running from those sectors.
+        :param plan: preprocessing.WritePlan that will be written later
+        """
+        flash_changed(self.stlink.stlink.serial_number)
+        self.session.command("halt", "Failed halting device %s" % self.stlink.stlink.name)
+        for index in self.sectors_for(plan.writes):
+            self._queue_erase(index)
+
+    def discard_erased(self):
+        """
+        Forgets about sectors erased for a plan that will not be written. Waits for erases in progress, so
+        the next write erases every sector it touches again.
+        """
+        with self.lock:
+            pending = list(self.erased.values())
+
+        for erased in pending:
+            erased.wait()
+
+        with self.lock:
+            self.erased.clear()
+            self.errors.clear()
+
+    def write(self, plan):
+        """
+        Programs a write plan. Sectors that were not pre-erased are queued for erasing up front, and each
+        sector is programmed and verified as soon as its erase completes. Raises FlashError on failure,
+        with the offset of the sector that failed.
+        :param plan: preprocessing.WritePlan built for this device
+        """
+        flash_changed(self.stlink.stlink.serial_number)
+        self.session.command("halt", "Failed halting device %s" % self.stlink.stlink.name)
+
+        indices = self.sectors_for(plan.writes)
+        for index in indices:
+            self._queue_erase(index)
+
+        base_offset = int(plan.link_address, 16) - FLASH_BASE
+
+        with open(plan.binary_file, 'rb') as image:
+            for index in indices:
+                sector_start, sector_size = self.sectors[index]
+                self.erased[index].wait()
+
+                try:
+                    error = self.errors.pop(index, None)
+                    if error:
+                        error.offset = sector_start
+                        raise error
+
+                    for offset, size in plan.writes:
+                        start = max(offset, sector_start)
+                        stop = min(offset + size, sector_start + sector_size)
+                        if start < stop:
+                            image.seek(start - base_offset)
+                            self._program(image.read(stop - start), start)
+                finally:
+                    # Programmed (or failed) sectors are no longer blank
+                    with self.lock:
+                        del self.erased[index]
+
+    def reset(self):
+        """
+        Resets the device and lets it run
+        """
+        self.session.command("reset run", "Failed resetting device %s" % self.stlink.stlink.name)
+
+    def _queue_erase(self, index):
+        with self.lock:
+            if index in self.erased:
+                return
+            self.erased[index] = threading.Event()
+
+        self.erase_queue.put(index)
+
+    def _erase_worker(self):
+        while True:
+            index = self.erase_queue.get()
+            if index is None:
+                return
+
+            try:
+                self.session.command("flash erase_sector 0 %d %d" % (index, index),
+                                     "Failed erasing sector %d of device %s" % (index, self.stlink.stlink.name))
+            except FlashError as error:
+                self.errors[index] = error
+            finally:
+                self.erased[index].set()
+
+    def _program(self, data, offset):
+        """
+        Programs and verifies data in an already erased part of flash
+        :param offset: where to write the data, relative to FLASH_BASE
+        """
+        region_file = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+        try:
+            region_file.write(data)
+            region_file.close()
+
+            for command in ("flash write_bank 0 {%s} 0x%x", "flash verify_bank 0 {%s} 0x%x"):
+                try:
+                    self.session.command(command % (region_file.name, offset),
+                                         "Failed programming %d bytes at location '0x%08x'" %
+                                         (len(data), FLASH_BASE + offset))
+                except FlashError as error:
+                    error.offset = offset
+                    raise
+        finally:
+            os.unlink(region_file.name)
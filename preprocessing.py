@@ -0,0 +1,184 @@
+import zlib
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from stlink import FLASH_BASE, flash_generation
+from tools import FlashError
+
+
+class WritePlan:
+    """
+    Everything a probe needs to program an image: which regions of flash actually have to be written.
+    Offsets are relative to FLASH_BASE.
+    """
+    __slots__ = ('binary_file', 'link_address', 'image_hash', 'sector_crcs', 'writes')
+
+    def __init__(self, binary_file, link_address, image_hash, sector_crcs, writes):
+        self.binary_file = binary_file
+        self.link_address = link_address
+        self.image_hash = image_hash
+        self.sector_crcs = sector_crcs
+        self.writes = writes
+
+    @property
+    def write_size(self):
+        return sum(size for _, size in self.writes)
+
+    def __repr__(self):
+        # Plans built without hashing the image (see recovery.RecoveryEngine.flash()) have no image_hash
+        return "WritePlan(%s, %s, %d region(s), %d bytes)" % (self.binary_file, (self.image_hash or '-')[:12],
+                                                               len(self.writes), self.write_size)
+
+
+def build_plan(binary_file, link_address, sectors, previous_crcs=None):
+    """
+    Hashes an image, computes the CRC32 of every sector it covers and works out which sectors differ from
+    the image previously flashed. Runs in a worker process.
+    :param binary_file: absolute path to the binary
+    :param link_address: program flash link address, eg "0x08000000"
+    :param sectors: (offset, size) sector layout of the target, see STLink.sectors
+    :param previous_crcs: sector_crcs of the plan last flashed to the board, or None to write everything
+    :return: WritePlan
+    """
+    with open(binary_file, 'rb') as file:
+        image = file.read()
+
+    base_offset = int(link_address, 16) - FLASH_BASE
+    end = base_offset + len(image)
+    previous = dict((offset, crc) for offset, _, crc in previous_crcs or ())
+
+    sector_crcs = []
+    writes = []
+    for sector_start, sector_size in sectors:
+        start = max(sector_start, base_offset)
+        stop = min(sector_start + sector_size, end)
+        if start >= stop:
+            continue
+
+        crc = zlib.crc32(image[start - base_offset:stop - base_offset])
+        sector_crcs.append((start, stop - start, crc))
+
+        if previous.get(start) == crc:
+            continue
+
+        # Merge neighbouring dirty sectors into one write
+        if writes and writes[-1][0] + writes[-1][1] == start:
+            writes[-1] = (writes[-1][0], writes[-1][1] + stop - start)
+        else:
+            writes.append((start, stop - start))
+
+    if not sector_crcs or sector_crcs[-1][0] + sector_crcs[-1][1] != end:
+        raise ValueError("Image %s does not fit in the flash of the target." % binary_file)
+
+    return WritePlan(binary_file, link_address, hashlib.sha256(image).hexdigest(), sector_crcs, writes)
+
+
+class ImagePreprocessor:
+    """
+    Moves image hashing, sector CRC computation and delta planning into a process pool so it overlaps
+    with flashing that is already in progress on other probes. Probes only ever receive a ready WritePlan.
+    """
+    def __init__(self, max_workers=None):
+        self.pool = ProcessPoolExecutor(max_workers=max_workers)
+
+        # serial -> (WritePlan last successfully flashed to that board, stlink.flash_generation() after it)
+        self.last_plans = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def remember(self, serial, plan):
+        """
+        Records the plan that was just flashed to a board, so the next one can be a delta against it
+        """
+        self.last_plans[serial] = (plan, flash_generation(serial))
+
+    def forget(self, serial):
+        """
+        Makes the next plan for a board write the whole image, eg after a failed write
+        """
+        self.last_plans.pop(serial, None)
+
+    def last_plan(self, serial):
+        """
+        :return: the plan last flashed to a board, or None if the board's flash has been changed since by
+                 anything else (see stlink.flash_changed()) and its contents are unknown
+        """
+        plan, generation = self.last_plans.get(serial, (None, None))
+        if plan is not None and generation != flash_generation(serial):
+            self.forget(serial)
+            return None
+        return plan
+
+    def submit(self, stlink, binary_file, link_address="0x08000000"):
+        """
+        Queues an image for preprocessing against the board attached to an STLink
+        :return: concurrent.futures.Future resolving to a WritePlan
+        """
+        previous = self.last_plan(stlink.stlink.serial_number)
+        previous_crcs = previous.sector_crcs if previous else None
+
+        return self.pool.submit(build_plan, binary_file, link_address, stlink.sectors, previous_crcs)
+
+    def flash_all(self, jobs, freq=None):
+        """
+        Preprocesses and flashes a batch of images. Every probe gets its own flashing thread that works
+        through its jobs in order as soon as their plans are ready.
+        :param jobs: iterable of (stlink, binary_file, link_address) tuples
+        :param freq: optional SWD clock frequency in kHz
+        :return: list of booleans, one per job, True if it flashed successfully
+        """
+        jobs = list(jobs)
+        results = [False] * len(jobs)
+        queues = {}
+
+        for index, (stlink, _, _) in enumerate(jobs):
+            queues.setdefault(stlink.stlink.serial_number, []).append(index)
+
+        def flash_probe(indices):
+            stlink = jobs[indices[0]][0]
+            serial = stlink.stlink.serial_number
+            future = self.submit(*jobs[indices[0]])
+
+            for position, index in enumerate(indices):
+                following = jobs[indices[position + 1]] if position + 1 < len(indices) else None
+
+                try:
+                    plan = future.result()
+                except Exception as error:
+                    # Eg an image that doesn't fit. Nothing was written, so the next plan is taken as usual.
+                    print("Failed planning %s for device %s: %s" % (jobs[index][1], stlink.stlink.name, error))
+                    if following:
+                        future = self.submit(*following)
+                    continue
+
+                # Start planning the next image as a delta against this one while it is being flashed
+                if following:
+                    future = self.pool.submit(build_plan, following[1], following[2], stlink.sectors,
+                                              plan.sector_crcs)
+
+                try:
+                    stlink.flash_plan(plan, freq=freq)
+                    results[index] = True
+                    self.remember(serial, plan)
+                except Exception as error:
+                    reason = error.failure if isinstance(error, FlashError) else error
+                    print("Failed flashing %s onto device %s: %s" % (plan.binary_file, stlink.stlink.name, reason))
+
+                    # Board contents are unknown now, so the next image has to be written in full
+                    self.forget(serial)
+                    if following:
+                        future.cancel()
+                        future = self.submit(*following)
+
+        with ThreadPoolExecutor(max_workers=max(len(queues), 1)) as flashers:
+            for future in [flashers.submit(flash_probe, indices) for indices in queues.values()]:
+                future.result()
+
+        return results
@@ -0,0 +1,206 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import inventory
+from pipeline import PipelinedWriter
+from preprocessing import ImagePreprocessor
+from stlink import STLink, STLink_USBInterface
+
+
+# Board states
+IDLE = 'idle'               # Nothing scheduled
+PREPARING = 'preparing'     # Write plan being built / sectors being erased for an upcoming job
+PREPARED = 'prepared'       # Only programming remains for the assigned job
+BUSY = 'busy'               # Being flashed or tested
+
+
+class Job:
+    """
+    An upcoming flash job
+    :param binary_file: absolute path to the binary to be flashed
+    :param chip_id: chip id of the boards that can run the job
+    :param link_address: program flash link address, defaults to 0x08000000
+    """
+    __slots__ = ('binary_file', 'chip_id', 'link_address')
+
+    def __init__(self, binary_file, chip_id, link_address="0x08000000"):
+        self.binary_file = binary_file
+        self.chip_id = chip_id
+        self.link_address = link_address
+
+    def __repr__(self):
+        return "Job(%s, 0x%03x)" % (self.binary_file, self.chip_id)
+
+
+class Board:
+    """
+    Pre-staging state of one attached board
+    """
+    __slots__ = ('record', 'stlink', 'writer', 'state', 'job', 'plan', 'ready')
+
+    def __init__(self, record, stlink, writer):
+        self.record = record
+        self.stlink = stlink
+        self.writer = writer
+        self.state = IDLE
+        self.job = None
+        self.plan = None
+        self.ready = None
+
+
+class PreStager:
+    """
+    Uses the time boards sit idle between jobs to get ahead on upcoming ones: the write plan is built and
+    the sectors it will program are erased, so that when a job lands only programming remains.
+    Each board is driven through a PipelinedWriter, so OpenOCD owns its probe while the stager is open.
+    """
+    def __init__(self, usb_interface, preprocessor=None, board_inventory=None):
+        """
+        :param usb_interface: STLink_USBInterface that has already run discover_devices()
+        :param preprocessor: ImagePreprocessor used to build write plans, one is created if not given
+        :param board_inventory: optional inventory.Inventory kept up to date with board states
+        """
+        self.preprocessor = preprocessor or ImagePreprocessor()
+        self._owns_preprocessor = preprocessor is None
+        self.inventory = board_inventory
+        self.lock = threading.Lock()
+        self.boards = []
+
+        for record in usb_interface.found_devices:
+            board_interface = STLink_USBInterface()
+            board_interface.attach_device(record)
+            stlink = STLink(board_interface)
+            self.boards.append(Board(record, stlink, PipelinedWriter(stlink)))
+
+        self.workers = ThreadPoolExecutor(max_workers=max(len(self.boards), 1))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.workers.shutdown()
+        for board in self.boards:
+            board.writer.close()
+
+        if self._owns_preprocessor:
+            self.preprocessor.shutdown()
+
+    def schedule(self, jobs):
+        """
+        Assigns upcoming jobs to idle boards with a matching chip and starts preparing them in the
+        background. Jobs that no idle board can take yet are left for a later call.
+        :param jobs: the upcoming job queue, in order
+        :return: list of jobs that were not assigned
+        """
+        unassigned = []
+        for job in jobs:
+            board = self._claim(job, IDLE, PREPARING)
+            if board is None:
+                unassigned.append(job)
+                continue
+
+            board.job = job
+            board.ready = self.workers.submit(self._prepare_scheduled, board)
+
+        return unassigned
+
+    def run(self, job):
+        """
+        Flashes a job onto a board, preferring one that was prepared for it, and leaves the board running
+        :param job: the Job to run. Boards prepared by schedule() are only used for that same Job object.
+        :return: the Board the job was flashed onto, or None if no matching board is available. Call
+                 release() once the board's test has finished.
+        """
+        board = self._claim(job, PREPARED, BUSY) or self._claim(job, PREPARING, BUSY)
+        prepared = board is not None
+
+        if not prepared:
+            board = self._claim(job, IDLE, BUSY)
+            if board is None:
+                return None
+            board.job = job
+
+        self._set_inventory_state(board, inventory.BUSY)
+
+        try:
+            if prepared:
+                # The plan may still be being built
+                board.ready.result()
+            else:
+                self._prepare(board, pre_erase=False)
+
+            board.writer.write(board.plan)
+        except Exception:
+            self.release(board)
+            raise
+
+        # Deltas for later plans are taken against what is on the board now
+        self.preprocessor.remember(board.record.serial, board.plan)
+        if self.inventory:
+            self.inventory.mark_flashed(board.record.serial, board.plan.image_hash)
+
+        board.writer.reset()
+        return board
+
+    def release(self, board):
+        """
+        Marks a board as idle again so it can be prepared for the next job
+        """
+        # Sectors erased for a job that never ran must not be mistaken for blank ones by the next write
+        board.writer.discard_erased()
+
+        with self.lock:
+            board.state = IDLE
+            board.job = None
+            board.plan = None
+            board.ready = None
+
+        self._set_inventory_state(board, inventory.IDLE)
+
+    def _claim(self, job, from_state, to_state):
+        with self.lock:
+            for board in self.boards:
+                if board.state != from_state or board.record.chipid != job.chip_id:
+                    continue
+                # Prepared boards are only handed to the job they were prepared for
+                if from_state != IDLE and board.job is not job:
+                    continue
+
+                board.state = to_state
+                return board
+
+        return None
+
+    def _prepare(self, board, pre_erase=True):
+        job = board.job
+        board.plan = self.preprocessor.submit(board.stlink, job.binary_file, job.link_address).result()
+
+        if pre_erase:
+            # The board no longer holds the image the last plan describes, so deltas can't be taken against it
+            self.preprocessor.forget(board.record.serial)
+            board.writer.pre_erase(board.plan)
+
+        with self.lock:
+            if board.state == PREPARING:
+                board.state = PREPARED
+
+    def _prepare_scheduled(self, board):
+        try:
+            self._prepare(board)
+        except Exception as error:
+            # If run() has not picked the board up yet, nobody will look at the failure, so free it here
+            with self.lock:
+                unclaimed = board.state == PREPARING
+                if unclaimed:
+                    board.state = BUSY
+            if unclaimed:
+                print("Failed preparing board %s for %s: %s" % (board.record.serial, board.job, error))
+                self.release(board)
+            raise
+
+    def _set_inventory_state(self, board, state):
+        if self.inventory:
+            self.inventory.set_state(board.record.serial, state)
@@ -0,0 +1,296 @@
+import struct
+
+
+class PackedRecord:
+    """
+    Base class for the compact, fixed-layout records used to describe probes, USB devices and parts.
+    Every record declares its fields in __slots__ (so no per-instance __dict__ is allocated) and a
+    struct layout used to pack it into a flat byte buffer for bulk storage.
+    """
+    __slots__ = ()
+
+    # Subclasses provide the struct used by pack()/unpack()
+    STRUCT = None
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join("%s=%r" % (field, getattr(self, field)) for field in self.__slots__)
+        return "%s(%s)" % (type(self).__name__, fields)
+
+    def to_dict(self):
+        """
+        Converts the record into a plain dictionary keyed by field name (suitable for json.dump())
+        """
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Builds a record from a dictionary previously produced by to_dict()
+        :param data: dictionary keyed by field name
+        """
+        return cls(**{field: data[field] for field in cls.__slots__ if field in data})
+
+    def pack(self):
+        raise NotImplementedError
+
+    @classmethod
+    def unpack(cls, buffer, offset=0):
+        raise NotImplementedError
+
+
+def _encode(string, size, field):
+    raw = (string or '').encode('utf-8')
+    if len(raw) > size:
+        raise ValueError("Field '%s' is longer than %d bytes: %r" % (field, size, string))
+    return raw
+
+
+def _truncate(string, size):
+    # Cut on a character boundary, so the packed bytes still decode
+    return (string or '').encode('utf-8')[:size].decode('utf-8', 'ignore')
+
+
+def _decode(raw):
+    return raw.rstrip(b'\x00').decode('utf-8')
+
+
+class ProbeRecord(PackedRecord):
+    """
+    Information reported by 'st-info --probe' about a single STLink programmer, along with the USB
+    port it was found on and the friendly name given to it by save_device().
+    """
+    __slots__ = ('serial', 'openocd', 'flash', 'sram', 'chipid', 'descr', 'usb_port', 'name')
+
+    # serial(128 bit), openocd, flash, sram, chipid, descr, usb_port, name
+    STRUCT = struct.Struct('<16s32sIIH16s8s32s')
+
+    # Longest name that survives pack(), in UTF-8 bytes
+    NAME_SIZE = 32
+
+    def __init__(self, serial, openocd, flash, sram, chipid, descr, usb_port=None, name=None):
+        self.serial = serial
+        self.openocd = openocd
+        self.flash = flash
+        self.sram = sram
+        self.chipid = chipid
+        self.descr = descr
+        self.usb_port = usb_port
+        self.name = name
+
+    @classmethod
+    def from_probe_fields(cls, fields):
+        """
+        Builds a record from the raw 'key: value' strings of one 'st-info --probe' block
+        :param fields: dictionary of the unparsed probe strings
+        """
+        openocd = fields['openocd'].strip('\"').replace('\\x', '')
+
+        return cls(serial=int(fields['serial']),
+                   openocd=openocd,
+                   flash=int(fields['flash']),
+                   sram=int(fields['sram']),
+                   chipid=int(fields['chipid'], 16),
+                   descr=fields.get('descr', ''))
+
+    def pack(self):
+        return self.STRUCT.pack(self.serial.to_bytes(16, 'big'),
+                                _encode(self.openocd, 32, 'openocd'),
+                                self.flash,
+                                self.sram,
+                                self.chipid,
+                                _encode(self.descr, 16, 'descr'),
+                                _encode(self.usb_port, 8, 'usb_port'),
+                                # Names can come from old device files, don't let one abort a bulk import
+                                _encode(_truncate(self.name, self.NAME_SIZE), self.NAME_SIZE, 'name'))
+
+    @classmethod
+    def unpack(cls, buffer, offset=0):
+        serial, openocd, flash, sram, chipid, descr, usb_port, name = cls.STRUCT.unpack_from(buffer, offset)
+
+        return cls(serial=int.from_bytes(serial, 'big'),
+                   openocd=_decode(openocd),
+                   flash=flash,
+                   sram=sram,
+                   chipid=chipid,
+                   descr=_decode(descr),
+                   usb_port=_decode(usb_port) or None,
+                   name=_decode(name) or None)
+
+
+class USBRecord(PackedRecord):
+    """
+    A single USB device as reported by lsusb
+    """
+    __slots__ = ('bus', 'address', 'id_vendor', 'id_product', 'tag')
+
+    STRUCT = struct.Struct('<BBHH48s')
+
+    def __init__(self, bus, address, id_vendor, id_product, tag=''):
+        self.bus = bus
+        self.address = address
+        self.id_vendor = id_vendor
+        self.id_product = id_product
+        self.tag = tag
+
+    @property
+    def device(self):
+        return '/dev/bus/usb/%03d/%03d' % (self.bus, self.address)
+
+    @property
+    def port(self):
+        """
+        The port in the <BUS>:<ADDR> format expected by the STLINK_DEVICE environment variable
+        """
+        return '%03d:%03d' % (self.bus, self.address)
+
+    def pack(self):
+        return self.STRUCT.pack(self.bus, self.address, self.id_vendor, self.id_product,
+                                _encode(self.tag, 48, 'tag'))
+
+    @classmethod
+    def unpack(cls, buffer, offset=0):
+        bus, address, id_vendor, id_product, tag = cls.STRUCT.unpack_from(buffer, offset)
+        return cls(bus, address, id_vendor, id_product, _decode(tag))
+
+
+class PartDefinition(PackedRecord):
+    """
+    One concrete part from the stm32devices.DEVICES table, flattened so that the family level
+    information (core, dev_id, flash driver, erase sizes...) is available directly on the part.
+    """
+    __slots__ = ('type', 'part_no', 'core', 'idcode_reg', 'dev_id', 'flash_size_reg', 'flash_driver',
+                 'erase_sizes', 'flash_size', 'sram_size', 'eeprom_size', 'freq')
+
+    MAX_ERASE_SIZES = 12
+
+    # type, part_no, core, idcode_reg, dev_id, flash_size_reg, flash_driver, erase count, erase sizes,
+    # flash_size, sram_size, eeprom_size, freq
+    STRUCT = struct.Struct('<16sH12sIHI12sB%dIHHfH' % MAX_ERASE_SIZES)
+
+    def __init__(self, type, part_no, core, idcode_reg, dev_id, flash_size_reg, flash_driver,
+                 erase_sizes, flash_size, sram_size, eeprom_size, freq):
+        self.type = type
+        self.part_no = part_no
+        self.core = core
+        self.idcode_reg = idcode_reg
+        self.dev_id = dev_id
+        self.flash_size_reg = flash_size_reg
+        self.flash_driver = flash_driver
+        self.erase_sizes = tuple(erase_sizes) if erase_sizes else None
+        self.flash_size = flash_size
+        self.sram_size = sram_size
+        self.eeprom_size = eeprom_size
+        self.freq = freq
+
+    def pack(self):
+        erase_sizes = self.erase_sizes or ()
+        if len(erase_sizes) > self.MAX_ERASE_SIZES:
+            raise ValueError("Part %s has more than %d erase sizes" % (self.type, self.MAX_ERASE_SIZES))
+
+        padded = erase_sizes + (0, ) * (self.MAX_ERASE_SIZES - len(erase_sizes))
+
+        return self.STRUCT.pack(_encode(self.type, 16, 'type'),
+                                self.part_no,
+                                _encode(self.core, 12, 'core'),
+                                self.idcode_reg,
+                                self.dev_id,
+                                self.flash_size_reg,
+                                _encode(self.flash_driver, 12, 'flash_driver'),
+                                len(erase_sizes),
+                                *padded,
+                                self.flash_size,
+                                self.sram_size,
+                                self.eeprom_size,
+                                self.freq)
+
+    @classmethod
+    def unpack(cls, buffer, offset=0):
+        values = cls.STRUCT.unpack_from(buffer, offset)
+        count = values[7]
+        erase_sizes = values[8:8 + count]
+        flash_size, sram_size, eeprom_size, freq = values[8 + cls.MAX_ERASE_SIZES:]
+
+        return cls(type=_decode(values[0]),
+                   part_no=values[1],
+                   core=_decode(values[2]),
+                   idcode_reg=values[3],
+                   dev_id=values[4],
+                   flash_size_reg=values[5],
+                   flash_driver=_decode(values[6]) or None,
+                   erase_sizes=erase_sizes,
+                   flash_size=flash_size,
+                   sram_size=sram_size,
+                   eeprom_size=eeprom_size,
+                   freq=freq)
+
+
+class RecordArray:
+    """
+    A list-like container that keeps records of a single type packed back to back in one bytearray.
+    Records are only materialized into objects when they are accessed, which keeps memory usage flat
+    when holding thousands of them.
+    """
+    def __init__(self, record_type, buffer=b''):
+        self.record_type = record_type
+        self.record_size = record_type.STRUCT.size
+
+        if len(buffer) % self.record_size:
+            raise ValueError("Buffer length %d is not a multiple of the %s size (%d bytes)" %
+                             (len(buffer), record_type.__name__, self.record_size))
+
+        self._buffer = bytearray(buffer)
+
+    def __len__(self):
+        return len(self._buffer) // self.record_size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        return self.record_type.unpack(self._buffer, index * self.record_size)
+
+    def __setitem__(self, index, record):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        offset = index * self.record_size
+        self._buffer[offset:offset + self.record_size] = record.pack()
+
+    def __iter__(self):
+        for offset in range(0, len(self._buffer), self.record_size):
+            yield self.record_type.unpack(self._buffer, offset)
+
+    def append(self, record):
+        self._buffer += record.pack()
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def tobytes(self):
+        return bytes(self._buffer)
+
+    def save(self, filename):
+        """
+        Writes the packed records to a binary file
+        :param filename: where to save the records
+        """
+        with open(filename, 'wb') as file:
+            file.write(self._buffer)
+
+    @classmethod
+    def load(cls, record_type, filename):
+        """
+        Loads records previously written with save()
+        :param record_type: the PackedRecord subclass stored in the file
+        :param filename: location of the records file
+        """
+        with open(filename, 'rb') as file:
+            return cls(record_type, file.read())
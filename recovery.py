@@ -0,0 +1,133 @@
+import os
+import time
+
+from preprocessing import WritePlan
+from stlink import FLASH_BASE
+from tools import FlashError, PROBE_LOST, NOT_HALTED, VERIFY_MISMATCH, TIMEOUT, UNKNOWN
+
+
+# Recovery actions taken before an operation is retried. Writes always pick up from the region that
+# failed, since st-flash verified everything written before it.
+RETRY = 'retry'               # Just try again
+RESET = 'reset'               # Reset the target first, eg to get a stuck core halted
+REENUMERATE = 'reenumerate'   # Find the probe again, it may have come back on another USB port
+
+# Regions written by RecoveryEngine.flash(). Small enough that a failure only costs one large sector.
+RESUME_CHUNK_SIZE = 256*1024
+
+
+class RecoveryPolicy:
+    """
+    What to do when an st-flash command fails in a particular way
+    :param retries: how many more attempts to make
+    :param action: one of RETRY, RESET or REENUMERATE
+    :param delay: seconds to wait before each new attempt
+    """
+    __slots__ = ('retries', 'action', 'delay')
+
+    def __init__(self, retries, action=RETRY, delay=0.0):
+        self.retries = retries
+        self.action = action
+        self.delay = delay
+
+
+DEFAULT_POLICIES = {
+    PROBE_LOST:         RecoveryPolicy(retries=3, action=REENUMERATE, delay=2.0),
+    NOT_HALTED:         RecoveryPolicy(retries=2, action=RESET),
+    VERIFY_MISMATCH:    RecoveryPolicy(retries=2, action=RETRY),
+    TIMEOUT:            RecoveryPolicy(retries=1, action=REENUMERATE, delay=1.0),
+    UNKNOWN:            RecoveryPolicy(retries=0),
+}
+
+
+class RecoveryEngine:
+    """
+    Wraps an STLink so that failed st-flash commands are retried according to the class of failure.
+    A failed write resumes from the region that failed instead of starting over.
+    """
+    def __init__(self, stlink, policies=None):
+        self.stlink = stlink
+        self.policies = dict(DEFAULT_POLICIES)
+        if policies:
+            self.policies.update(policies)
+
+    def erase(self):
+        self._run(lambda: self.stlink.erase())
+
+    def reset(self):
+        self._run(lambda: self.stlink.reset())
+
+    def flash(self, binary_file, link_address="0x08000000", freq=None, chunk_size=RESUME_CHUNK_SIZE):
+        """
+        Flashes an image in sector aligned regions, resuming from the last good region after a failure
+        :param binary_file: absolute path to the binary to be flashed
+        :param link_address: program flash link address, defaults to 0x08000000
+        :param freq: SWD clock frequency in kHz, defaults to whatever st-flash picks
+        :param chunk_size: approximate size of each region, see STLink.flash()
+        """
+        base_offset = int(link_address, 16) - FLASH_BASE
+        writes = self.stlink.chunks(base_offset, os.path.getsize(binary_file), chunk_size)
+
+        self.flash_plan(WritePlan(binary_file, link_address, None, None, writes), freq=freq)
+
+    def flash_plan(self, plan, freq=None):
+        """
+        Flashes a write plan (see preprocessing.ImagePreprocessor), resuming from the region that failed
+        """
+        remaining = [plan]
+
+        def write():
+            try:
+                self.stlink.flash_plan(remaining[0], freq=freq)
+            except FlashError as error:
+                # Everything before the failed region is already programmed
+                if error.offset is not None:
+                    writes = [region for region in remaining[0].writes if region[0] >= error.offset]
+                    remaining[0] = WritePlan(plan.binary_file, plan.link_address, plan.image_hash,
+                                             plan.sector_crcs, writes)
+                raise
+
+        self._run(write)
+
+    def _run(self, operation):
+        """
+        Runs an operation until it succeeds or the policy for its failure gives up. A recovery action that
+        fails counts as a failed attempt, handled by the policy for its own failure.
+        """
+        attempts = {}
+        action = None
+
+        while True:
+            try:
+                if action is not None:
+                    self._recover(action)
+                return operation()
+            except FlashError as error:
+                policy = self.policies.get(error.failure, self.policies[UNKNOWN])
+                attempts[error.failure] = attempts.get(error.failure, 0) + 1
+
+                if attempts[error.failure] > policy.retries:
+                    raise
+
+                print("Device %s: %s (%s), attempting recovery %d/%d by %s." %
+                      (self.stlink.stlink.name, error, error.failure, attempts[error.failure], policy.retries,
+                       policy.action))
+
+                time.sleep(policy.delay)
+                action = policy.action
+
+    def _recover(self, action):
+        usb_dev = self.stlink.stlink
+
+        if action == REENUMERATE:
+            port = usb_dev.get_port_from_serial(usb_dev.serial_number)
+            if not port:
+                # Counts as another failed attempt, the probe may still come back within the policy's retries
+                raise FlashError("Device %s has disappeared! Where did it go?" % usb_dev.name, PROBE_LOST)
+
+            if port != usb_dev.port:
+                print("Device %s rediscovered on port %s." % (usb_dev.name, port))
+                usb_dev.attached_device.usb_port = port
+
+        elif action == RESET:
+            self.stlink.reset()
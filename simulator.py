@@ -0,0 +1,218 @@
+import time
+import hashlib
+import threading
+
+import compressed_transfer as stub
+from compression import decompress
+from records import ProbeRecord
+from stlink import FLASH_BASE, SRAM_BASE
+
+
+class SimulatedHub:
+    """
+    A USB hub shared by several probes. Each transfer runs at up to device_rate bytes/s, but together
+    they cannot exceed the hub's bandwidth, and every extra concurrent transfer costs some of that
+    bandwidth to contention (split transactions, NAK retries...), so there is a best level of concurrency.
+    """
+    def __init__(self, bandwidth=30e6, device_rate=10e6, contention=0.08, time_step=0.005):
+        self.bandwidth = bandwidth
+        self.device_rate = device_rate
+        self.contention = contention
+        self.time_step = time_step
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def rate(self, active):
+        """
+        Throughput of one transfer when active transfers share the hub
+        """
+        usable = self.bandwidth * max(0.1, 1 - self.contention * (active - 1))
+        return min(self.device_rate, usable / active)
+
+    def transfer(self, size):
+        """
+        Moves size bytes through the hub, taking as long as the shared bandwidth allows
+        :return: size, the number of bytes transferred
+        """
+        with self.lock:
+            self.active += 1
+        try:
+            remaining = size
+            while remaining > 0:
+                with self.lock:
+                    rate = self.rate(self.active)
+                remaining -= rate * self.time_step
+                time.sleep(self.time_step)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+        return size
+
+
+class SimulatedTarget:
+    """
+    A target running the decompression stub (see compressed_transfer.py), for trying compressed transfers
+    without hardware. Memory writes take as long as the SWD link needs for them, and the stub is emulated
+    by a thread that follows the mailbox protocol, decoding with compression.decompress() and programming
+    a simulated flash at flash_rate bytes/s. Like real flash, programming can only clear bits.
+    """
+    # Tells CompressedWriter that no stub binary has to be loaded
+    emulates_stub = True
+
+    def __init__(self, sram_size, sectors, link_rate=150e3, flash_rate=250e3, erase_rate=128e3, latency=0.001):
+        """
+        :param sram_size: SRAM size in bytes
+        :param sectors: (offset, size) of each flash sector
+        :param link_rate: SWD memory write throughput in bytes/s
+        :param flash_rate: programming throughput in bytes/s
+        :param erase_rate: erase throughput in bytes/s
+        :param latency: time taken by every command sent to the target
+        """
+        self.sram_base = SRAM_BASE
+        self.sram = bytearray(sram_size)
+        self.sectors = sectors
+        self.flash = bytearray(b'\xff' * sum(size for _, size in sectors))
+        self.link_rate = link_rate
+        self.flash_rate = flash_rate
+        self.erase_rate = erase_rate
+        self.latency = latency
+
+        self.condition = threading.Condition()
+        self.stub = None
+        self.running = False
+
+    def _offset(self, address, length):
+        offset = address - self.sram_base
+        if offset < 0 or offset + length > len(self.sram):
+            raise ValueError("Write to 0x%08x outside SRAM" % address)
+        return offset
+
+    def _word(self, address):
+        offset = self._offset(address, 4)
+        return int.from_bytes(self.sram[offset:offset + 4], 'little')
+
+    def _set_word(self, address, value):
+        offset = self._offset(address, 4)
+        self.sram[offset:offset + 4] = value.to_bytes(4, 'little')
+
+    def write_memory(self, address, data):
+        time.sleep(self.latency + len(data) / self.link_rate)
+        offset = self._offset(address, len(data))
+        with self.condition:
+            self.sram[offset:offset + len(data)] = data
+            self.condition.notify_all()
+
+    def write_words(self, address, words):
+        self.write_memory(address, b''.join(word.to_bytes(4, 'little') for word in words))
+
+    def read_word(self, address):
+        time.sleep(self.latency)
+        with self.condition:
+            return self._word(address)
+
+    def wait_while(self, address, value, timeout=10):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self._word(address) != value, timeout):
+                raise TimeoutError("Timed out waiting for 0x%08x" % address)
+
+    def reset_halt(self):
+        self.halt()
+        time.sleep(self.latency)
+
+    def start(self, entry, stack_pointer):
+        time.sleep(self.latency)
+        self.running = True
+        self.stub = threading.Thread(target=self._run_stub, daemon=True)
+        self.stub.start()
+
+    def halt(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.stub is not None:
+            self.stub.join()
+            self.stub = None
+
+    def _run_stub(self):
+        with self.condition:
+            self._set_word(stub.MAILBOX_MAGIC, stub.STUB_MAGIC)
+            self.condition.notify_all()
+
+        index = 0
+        while True:
+            slot = stub.SLOTS + index * stub.SLOT_SIZE
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running or self._word(slot) == stub.SLOT_READY)
+                if not self.running:
+                    return
+                source, compressed_length, raw_length, destination, flags = [self._word(slot + 4 * word)
+                                                                              for word in range(1, 6)]
+                offset = self._offset(source, compressed_length)
+                data = bytes(self.sram[offset:offset + compressed_length])
+
+            if not flags & stub.FLAG_RAW:
+                data = decompress(data, raw_length)
+
+            status = self._program(destination - FLASH_BASE, data, flags)
+
+            with self.condition:
+                self._set_word(slot + stub.SLOT_STATUS, status)
+                self._set_word(slot + stub.SLOT_STATE, stub.SLOT_DONE)
+                self.condition.notify_all()
+
+            index = (index + 1) % stub.SLOT_COUNT
+
+    def _program(self, offset, data, flags):
+        if flags & stub.FLAG_ERASE:
+            sector_offset, sector_size = self.sectors[(flags >> 8) & 0x1F]
+            time.sleep(sector_size / self.erase_rate)
+            self.flash[sector_offset:sector_offset + sector_size] = b'\xff' * sector_size
+
+        time.sleep(len(data) / self.flash_rate)
+        for index, byte in enumerate(data):
+            self.flash[offset + index] &= byte
+
+        return 0 if self.flash[offset:offset + len(data)] == data else stub.STATUS_VERIFY_FAIL
+
+
+class SimulatedProbe:
+    """
+    An STLink with a board attached. Flashing takes as long as the image needs at rate bytes/s (or through
+    a SimulatedHub), and the probe remembers the hash of the image it was given.
+    """
+    def __init__(self, serial, chip_id=0x451, flash_size=0x200000, sram_size=0x80000, rate=200e3, hub=None,
+                 usb_port=None):
+        self.record = ProbeRecord(serial, '', flash_size, sram_size, chip_id, 'simulated', usb_port)
+        self.rate = rate
+        self.hub = hub
+        self.image_hash = None
+        self.flash_count = 0
+
+    def flash(self, binary_file, link_address="0x08000000"):
+        with open(binary_file, 'rb') as file:
+            image = file.read()
+        if int(link_address, 16) - FLASH_BASE + len(image) > self.record.flash:
+            raise ValueError("Image does not fit in the flash of the attached device.")
+
+        if self.hub is not None:
+            self.hub.transfer(len(image))
+        else:
+            time.sleep(len(image) / self.rate)
+
+        self.image_hash = hashlib.sha256(image).hexdigest()
+        self.flash_count += 1
+
+
+class SimulatedBackend:
+    """
+    Stands in for distributed.LocalBackend on a host with simulated probes attached
+    """
+    def __init__(self, probes):
+        self.probes = {probe.record.serial: probe for probe in probes}
+
+    def discover(self, busy=()):
+        return [probe.record for probe in self.probes.values()]
+
+    def flash(self, serial, binary_file, link_address="0x08000000"):
+        self.probes[serial].flash(binary_file, link_address)
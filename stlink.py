@@ -1,8 +1,58 @@
 import os
 import re
+import mmap
+import struct
 import json
 import time
+import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import openocd
+from performance import DISCOVER, FLASH, timed
+from records import ProbeRecord, USBRecord
+from stm32devices import find_parts, sector_layout
+from tools import FlashError, classify_failure, run_command
+
+
+FLASH_BASE = 0x08000000
+SRAM_BASE = 0x20000000
+
+# Cortex-M vector table offset register
+SCB_VTOR = 0xE000ED08
+
+# Largest single st-flash read when dumping flash, see STLink.dump()
+DUMP_CHUNK_SIZE = 256 * 1024
+
+
+# serial -> how many times this process has started writing or erasing that board's flash
+_flash_generations = {}
+_flash_generations_lock = threading.Lock()
+
+
+def flash_changed(serial):
+    """
+    Notes that a board's flash is being written or erased. Every path that changes flash calls this, so
+    deltas taken against what was last flashed (see preprocessing.ImagePreprocessor) are not trusted after it.
+    """
+    with _flash_generations_lock:
+        _flash_generations[serial] = _flash_generations.get(serial, 0) + 1
+
+
+def flash_generation(serial):
+    """
+    :return: a number that changes whenever flash_changed() is called for the board
+    """
+    with _flash_generations_lock:
+        return _flash_generations.get(serial, 0)
+
+
+def erased_map_file(dump_file):
+    """
+    :return: the sidecar file STLink.dump() lists a dump's erased sectors in, <dump name>.erased.json
+    """
+    return os.path.splitext(dump_file)[0] + ".erased.json"
 
 
 class STLink_USBInterface:
@@ -28,44 +78,52 @@ class STLink_USBInterface:
         }
     ]
 
-    def __init__(self):
+    def __init__(self, history=None):
+        """
+        :param history: optional performance.PerformanceHistory that discovery times are recorded in
+        """
         self.stlink_devices = []
         self.usb_devices = None
-        self.attached_device = {}
+        self.attached_device = None
+        self.history = history
 
     def discover_devices(self):
         """
         Finds all connected STLink devices and populates information about them into the
         class self.stlink_devices list.
         """
-        # First let the STLink firmware discover devices
-        self._stlink_probe()
+        with timed(self.history, DISCOVER):
+            # First let the STLink firmware discover devices
+            self._stlink_probe()
 
-        if self.stlink_devices:
-            print("Discovered %d STLink device(s)." % len(self.stlink_devices))
+            if self.stlink_devices:
+                print("Discovered %d STLink device(s)." % len(self.stlink_devices))
 
-            # Grab lower level information about the USB devices (port, dev-id, etc)
-            self._get_usb_devices()
+                # Grab lower level information about the USB devices (port, dev-id, etc)
+                self._get_usb_devices()
 
-            # Use the information from STLink probe and USB to build a more complete picture
-            # of which device is on which port
-            self._assign_port_to_device()
+                # Use the information from STLink probe and USB to build a more complete picture
+                # of which device is on which port
+                self._assign_port_to_device()
 
-        else:
-            print("No STLink devices were discovered.")
+            else:
+                print("No STLink devices were discovered.")
 
     def save_device(self, name, filename):
         """
         Saves an attached device settings to file
-        :param name: A unique friendly name for this device
+        :param name: A unique friendly name for this device, at most ProbeRecord.NAME_SIZE bytes of UTF-8
         :param filename: where to save the file (must include .json extension)
         """
+        if len(name.encode('utf-8')) > ProbeRecord.NAME_SIZE:
+            raise ValueError("Device name %r is longer than %d bytes." % (name, ProbeRecord.NAME_SIZE))
+
         if self.attached_device:
-            self.attached_device['name'] = name
+            self.attached_device.name = name
 
             if filename.endswith(".json"):
                 with open(filename, 'w') as file:
-                    json.dump(self.attached_device, file)
+                    json.dump(self.attached_device.to_dict(), file)
             else:
                 raise ValueError("Could not save file. Expected a .json extension.")
 
@@ -80,9 +138,9 @@ class STLink_USBInterface:
 
         if filename.endswith(".json"):
             with open(filename) as file:
-                self.attached_device = json.loads(file.read())
+                self.attached_device = ProbeRecord.from_dict(json.loads(file.read()))
 
-            print("Loaded device: %s" % self.attached_device["name"])
+            print("Loaded device: %s" % self.attached_device.name)
         else:
             raise ValueError("Cannot load file. Expected a .json extension.")
 
@@ -99,9 +157,9 @@ class STLink_USBInterface:
         :param serial_number: Serial number of device to be attached
         """
         if self.stlink_devices:
-            for i in range(0, len(self.stlink_devices)):
-                if self.stlink_devices[i]["serial"] == serial_number:
-                    self.attached_device = self.stlink_devices[i]
+            for device in self.stlink_devices:
+                if device.serial == serial_number:
+                    self.attached_device = device
                     print("Device attached.")
                     return
 
@@ -116,12 +174,8 @@ class STLink_USBInterface:
         self._get_usb_devices()
 
         for usb_device in self.usb_devices:
-            # The port is listed as "/~/~/bus/addr
-            port_split = list(filter(None, usb_device["device"].split('/')))
-            usb_port = port_split[3] + ":" + port_split[4]
-
-            if serial == self.get_serial_number(usb_port):
-                return usb_port
+            if serial == self.get_serial_number(usb_device.port):
+                return usb_device.port
 
         return None
 
@@ -140,7 +194,7 @@ class STLink_USBInterface:
 
     def _get_usb_devices(self):
         """
-        Finds all the connected usb devices on the computer and reports them back in a neat dictionary
+        Finds all the connected usb devices on the computer and reports them back as USBRecords
         Courtesy of:
             1) https://goo.gl/m52UG7
             2) https://goo.gl/yXziE6
@@ -156,13 +210,17 @@ class STLink_USBInterface:
                 info = device_re.match(i)
                 if info:
                     dinfo = info.groupdict()
-                    dinfo['device'] = '/dev/bus/usb/%s/%s' % (dinfo.pop('bus'), dinfo.pop('device'))
-                    devices.append(dinfo)
+                    id_vendor, id_product = dinfo['id'].split(':')
+                    devices.append(USBRecord(bus=int(dinfo['bus']),
+                                             address=int(dinfo['device']),
+                                             id_vendor=int(id_vendor, 16),
+                                             id_product=int(id_product, 16),
+                                             tag=dinfo['tag']))
 
         # Filter only for the STLink devices
         st_link_devices = []
         for device in devices:
-            if self.STLINK_VENDOR_ID in device['id']:
+            if device.id_vendor == int(self.STLINK_VENDOR_ID, 16):
                 st_link_devices.append(device)
 
         self.usb_devices = st_link_devices
@@ -187,47 +245,40 @@ class STLink_USBInterface:
 
             # Gather all the characteristics for the discovered devices
             for i in range(0, total_found):
-                self.stlink_devices.append({})
-
                 # Info is given in repeating blocks of 6 lines that must be parsed
                 offset = i*6
                 device_data = probe_data[0+offset:6+offset]
 
+                fields = {}
                 for field in device_data:
                     data = field.split(' ')
-                    self.stlink_devices[i][data[0].strip(':')] = data[1]
-
-                # Apply special filtering to known probe return values
-                self.stlink_devices[i]['serial']  = int(self.stlink_devices[i]['serial'])
-                self.stlink_devices[i]['flash']   = int(self.stlink_devices[i]['flash'])
-                self.stlink_devices[i]['sram']    = int(self.stlink_devices[i]['sram'])
-                self.stlink_devices[i]['chipid']  = int(self.stlink_devices[i]['chipid'], 16)
+                    fields[data[0].strip(':')] = data[1]
 
-                self.stlink_devices[i]['openocd'] = self.stlink_devices[i]['openocd'].strip('\"')
-                self.stlink_devices[i]['openocd'] = self.stlink_devices[i]['openocd'].replace('\\x', '')
+                # Convert the known probe return values into a record
+                self.stlink_devices.append(ProbeRecord.from_probe_fields(fields))
 
     def _assign_port_to_device(self):
         """
         Pairs discovered STLink programmers with the correct USB port/bus in the device dictionary
         """
-        for i in range(0, len(self.stlink_devices)):
-            self.stlink_devices[i]['usb_port'] = self.get_port_from_serial(self.stlink_devices[i]['serial'])
+        for device in self.stlink_devices:
+            device.usb_port = self.get_port_from_serial(device.serial)
 
     @property
     def port(self):
-        return self.attached_device['usb_port']
+        return self.attached_device.usb_port
 
     @property
     def name(self):
-        return self.attached_device['name']
+        return self.attached_device.name
 
     @property
     def serial_number(self):
-        return self.attached_device['serial']
+        return self.attached_device.serial
 
     @property
     def chip_id(self):
-        return self.attached_device['chipid']
+        return self.attached_device.chipid
 
     @property
     def found_devices(self):
@@ -238,11 +289,15 @@ class STLink:
     """
     High level interface to an STLink device that defines commonly used operations
     """
-    def __init__(self, usb_dev):
+    def __init__(self, usb_dev, history=None):
+        """
+        :param usb_dev: STLink_USBInterface with the device attached
+        :param history: optional performance.PerformanceHistory that flash times are recorded in
+        """
         # Make sure the USB port recorded in the interface matches the recorded serial number
         if usb_dev.serial_number != usb_dev.get_serial_number(usb_dev.port):
             print("Device %s not found. Previously used on port %s." % (usb_dev.name, usb_dev.port))
-            usb_dev.attached_device['usb_port'] = usb_dev.get_port_from_serial(usb_dev.serial_number)
+            usb_dev.attached_device.usb_port = usb_dev.get_port_from_serial(usb_dev.serial_number)
 
             if not usb_dev.port:
                 raise ConnectionError("Device %s has disappeared! Where did it go?" % usb_dev.name)
@@ -251,33 +306,291 @@ class STLink:
 
 
         self.stlink = usb_dev
+        self.history = history
+
+    @property
+    def sectors(self):
+        """
+        Gets the (offset, size) of each erasable flash sector of the attached part, relative to FLASH_BASE
+        """
+        parts = find_parts(self.stlink.chip_id)
+        if not parts:
+            raise ValueError("Unknown chip id 0x%x, no sector information available." % self.stlink.chip_id)
+
+        return sector_layout(parts[0], self.stlink.attached_device.flash)
 
     def erase(self):
         """
         Performs a mass erase on the attached STLink device
         """
-        command = "export STLINK_DEVICE=" + self.stlink.port + "; st-flash erase"
-        subprocess.run(command, shell=True)
+        flash_changed(self.stlink.serial_number)
+        self._check(self._st_flash("erase"), "Failed erasing device %s" % self.stlink.name)
         time.sleep(1)
 
-    def flash(self, binary_file, link_address="0x08000000"):
+    def flash(self, binary_file, link_address="0x08000000", freq=None, chunk_size=None, operation=FLASH):
         """
-        Flashes the attached STLink device
+        Flashes the attached STLink device. Raises FlashError if a write fails.
         :param binary_file: absolute path to the binary to be flashed
         :param link_address: program flash link address, defaults to 0x08000000
+        :param freq: SWD clock frequency in kHz, defaults to whatever st-flash picks
+        :param chunk_size: if given, the image is written in pieces of about this many bytes. Pieces always
+                           start and end on a sector boundary because st-flash erases every sector it touches.
+        :param operation: what the timing is recorded as in the performance history, see performance.TUNE
         """
-        command = "export STLINK_DEVICE=" + self.stlink.port + "; st-flash write " + binary_file + " " + link_address
-        subprocess.run(command, shell=True)
+        base_offset = int(link_address, 16) - FLASH_BASE
+        flash_changed(self.stlink.serial_number)
+
+        with timed(self.history, operation, serial=self.stlink.serial_number, chip_id=self.stlink.chip_id,
+                   image_size=os.path.getsize(binary_file)):
+            if chunk_size is None:
+                output = self._st_flash("write " + binary_file + " " + link_address, freq=freq)
+                self._check(output, "Failed flashing '%s' at location '%s'" % (binary_file, link_address),
+                            base_offset)
+            else:
+                with open(binary_file, 'rb') as file:
+                    image = file.read()
+
+                for offset, size in self.chunks(base_offset, len(image), chunk_size):
+                    self._write_region(image[offset - base_offset:offset - base_offset + size], offset, freq)
+
         time.sleep(1)
 
+    def flash_plan(self, plan, freq=None):
+        """
+        Flashes only the regions listed in a write plan (see preprocessing.ImagePreprocessor). Raises
+        FlashError if a write fails.
+        :param plan: preprocessing.WritePlan built for this device
+        :param freq: SWD clock frequency in kHz, defaults to whatever st-flash picks
+        """
+        base_offset = int(plan.link_address, 16) - FLASH_BASE
+        flash_changed(self.stlink.serial_number)
+
+        with open(plan.binary_file, 'rb') as file:
+            for offset, size in plan.writes:
+                file.seek(offset - base_offset)
+                self._write_region(file.read(size), offset, freq)
+
+        if plan.writes:
+            time.sleep(1)
+
     def reset(self):
         """
         Resets the attached STLink device
         """
-        command = "export STLINK_DEVICE=" + self.stlink.port + "; st-flash reset"
-        subprocess.run(command, shell=True)
+        self._check(self._st_flash("reset"), "Failed resetting device %s" % self.stlink.name)
         time.sleep(1)
 
+    @property
+    def sram_size(self):
+        """
+        Size in bytes of the attached part's SRAM
+        """
+        if self.stlink.attached_device.sram:
+            return self.stlink.attached_device.sram
+
+        parts = find_parts(self.stlink.chip_id)
+        if not parts:
+            raise ValueError("Unknown chip id 0x%x, no SRAM information available." % self.stlink.chip_id)
+
+        return min(part.sram_size for part in parts) * 1024
+
+    def run_from_sram(self, binary_file, flash_binary_file=None, link_address="0x08000000"):
+        """
+        Loads an image straight into SRAM and starts it without touching flash. The image must be linked to
+        run from SRAM_BASE. If it does not fit in the attached part's SRAM (or is not linked for SRAM) the
+        flash build is programmed and the device reset instead.
+        :param binary_file: absolute path to the SRAM linked binary
+        :param flash_binary_file: absolute path to the flash linked binary used as a fallback, defaults to
+                                  binary_file
+        :param link_address: program flash link address for the fallback, defaults to 0x08000000
+        :return: True if the image was run from SRAM, False if the flash fallback was used
+        """
+        with open(binary_file, 'rb') as file:
+            vectors = file.read(8)
+        image_size = os.path.getsize(binary_file)
+        sram_end = SRAM_BASE + self.sram_size
+
+        # The first two vectors are the initial stack pointer and the reset handler
+        stack_pointer, reset_handler = struct.unpack('<II', vectors) if len(vectors) == 8 else (0, 0)
+
+        if image_size > self.sram_size:
+            print("%s is %d bytes, too large for %d bytes of SRAM. Using flash." %
+                  (binary_file, image_size, self.sram_size))
+        elif not (SRAM_BASE <= stack_pointer <= sram_end and SRAM_BASE <= reset_handler < SRAM_BASE + image_size):
+            print("%s is not linked to run from SRAM. Using flash." % binary_file)
+        else:
+            self._openocd(["init",
+                           "reset halt",
+                           "load_image %s 0x%08x bin" % (binary_file, SRAM_BASE),
+                           "mww 0x%08x 0x%08x" % (SCB_VTOR, SRAM_BASE),
+                           "reg msp 0x%08x" % stack_pointer,
+                           "reg pc 0x%08x" % (reset_handler & ~1),
+                           "resume",
+                           "shutdown"],
+                          "Failed running '%s' from SRAM" % binary_file)
+            return True
+
+        self.flash(flash_binary_file or binary_file, link_address)
+        self.reset()
+        return False
+
+    def dump(self, output_file, freq=None, chunk_size=DUMP_CHUNK_SIZE, sparse=True):
+        """
+        Reads the whole flash of the attached device into a file. Each chunk is read by st-flash into a
+        temporary file and copied into the memory mapped output, so host memory use stays flat whatever the
+        size of the part. Chunks follow the sector layout, and sectors that are fully erased are left as
+        holes in a sparse output file. The erased sectors are also written as a JSON list of [offset, size]
+        next to the dump (see erased_map_file()), since the holes themselves read back as 0x00.
+        Raises FlashError if a read fails.
+        :param output_file: where to write the dump, overwritten if it exists
+        :param freq: SWD clock frequency in kHz, defaults to whatever st-flash picks
+        :param chunk_size: largest single read in bytes, reads always begin and end on sector boundaries
+        :param sparse: leave erased sectors as holes. Holes read back as 0x00 rather than 0xFF, set to False
+                       to have them filled with 0xFF instead.
+        :return: list of (offset, size) of the erased sectors
+        """
+        flash_size = self.stlink.attached_device.flash
+        erased_sector = bytes([0xFF]) * max(size for _, size in self.sectors)
+        erased = []
+
+        with open(output_file, 'w+b') as output:
+            # Extending the file leaves the whole of it as a hole until something is written
+            output.truncate(flash_size)
+            with mmap.mmap(output.fileno(), flash_size) as dump:
+                for offset, size in self.chunks(0, flash_size, chunk_size):
+                    with tempfile.NamedTemporaryFile(suffix='.bin') as chunk_file:
+                        address = "0x%08x" % (FLASH_BASE + offset)
+                        result = self._st_flash("read %s %s %d" % (chunk_file.name, address, size), freq=freq)
+                        self._check(result, "Failed reading %d bytes at location '%s'" % (size, address), offset)
+
+                        with open(chunk_file.name, 'rb') as file, mmap.mmap(file.fileno(), 0,
+                                                                              access=mmap.ACCESS_READ) as chunk:
+                            if len(chunk) != size:
+                                raise FlashError("Read %d bytes at location '%s', expected %d" %
+                                                 (len(chunk), address, size), offset=offset)
+                            self._copy_sectors(chunk, dump, offset, erased_sector, erased, sparse)
+
+                dump.flush()
+
+        with open(erased_map_file(output_file), 'w') as file:
+            json.dump(erased, file)
+
+        return erased
+
+    def _copy_sectors(self, chunk, dump, offset, erased_sector, erased, sparse):
+        """
+        Copies the sectors in a chunk that was read from flash into the dump, skipping erased ones
+        """
+        with memoryview(chunk) as chunk_view, memoryview(erased_sector) as erased_view:
+            for sector_offset, sector_size in self.sectors:
+                start = sector_offset - offset
+                if start < 0 or start >= len(chunk):
+                    continue
+
+                with chunk_view[start:start + sector_size] as sector:
+                    if sector == erased_view[:sector_size]:
+                        erased.append((sector_offset, sector_size))
+                        if sparse:
+                            continue
+
+                    dump[sector_offset:sector_offset + sector_size] = sector
+
+    def _st_flash(self, arguments, freq=None):
+        """
+        Runs an st-flash command against the attached device. Its output is echoed as it arrives and also
+        kept in the returned CompletedProcess so failures can be classified.
+        :param arguments: the st-flash command and its arguments, eg "write file.bin 0x08000000"
+        :param freq: optional SWD clock frequency in kHz
+        """
+        command = "export STLINK_DEVICE=" + self.stlink.port + "; st-flash "
+        if freq:
+            command += "--freq=%dk " % freq
+
+        return run_command(command + arguments, shell=True, echo=True)
+
+    def _openocd(self, commands, message):
+        """
+        Runs a list of OpenOCD commands against the attached device. OpenOCD is used for the few operations
+        st-flash cannot do, like loading into SRAM and setting core registers. Raises FlashError on failure.
+        :param commands: OpenOCD commands to run, in order
+        :param message: the FlashError message used if the commands fail
+        """
+        output = run_command(openocd.openocd_arguments(self.stlink) + ["-c", "; ".join(commands)])
+        self._check(output, message)
+        return output
+
+    def _check(self, output, message, offset=None):
+        """
+        Raises a FlashError if an st-flash or OpenOCD command failed
+        """
+        if output.returncode != 0:
+            text = output.stdout.decode("utf-8", "replace").strip()
+            raise FlashError(message, classify_failure(text), text, offset)
+
+    def _write_region(self, data, offset, freq=None):
+        """
+        Writes a block of data into flash through a temporary file. Raises FlashError if the write fails.
+        :param offset: where to write the data, relative to FLASH_BASE
+        """
+        with tempfile.NamedTemporaryFile(suffix='.bin') as region_file:
+            region_file.write(data)
+            region_file.flush()
+
+            address = "0x%08x" % (FLASH_BASE + offset)
+            output = self._st_flash("write %s %s" % (region_file.name, address), freq=freq)
+
+        self._check(output, "Failed flashing %d bytes at location '%s'" % (len(data), address), offset)
+
+    def chunks(self, offset, length, chunk_size):
+        """
+        Splits a region of flash into pieces of at most chunk_size bytes that begin and end on sector
+        boundaries (or the region boundaries). A sector larger than chunk_size gets a piece of its own.
+        :return: list of (offset, size) tuples, relative to FLASH_BASE
+        """
+        end = offset + length
+        chunks = []
+        chunk_start = None
+        chunk_end = None
+
+        for sector_start, sector_size in self.sectors:
+            start = max(sector_start, offset)
+            stop = min(sector_start + sector_size, end)
+            if start >= stop:
+                continue
+
+            if chunk_start is not None and stop - chunk_start > chunk_size:
+                chunks.append((chunk_start, chunk_end - chunk_start))
+                chunk_start = None
+
+            if chunk_start is None:
+                chunk_start = start
+            chunk_end = stop
+
+        if chunk_start is not None:
+            chunks.append((chunk_start, chunk_end - chunk_start))
+
+        if chunk_end != end:
+            raise ValueError("Image does not fit in the flash of the attached device.")
+
+        return chunks
+
+
+def dump_devices(stlinks, directory, freq=None):
+    """
+    Dumps the flash of several devices in parallel, see STLink.dump()
+    :param stlinks: STLinks of the devices to dump
+    :param directory: the dumps are written to <directory>/<serial>.bin, and their erased sectors to
+                      <directory>/<serial>.erased.json
+    :return: {serial: list of erased (offset, size) sectors}
+    """
+    def dump_one(stlink):
+        return stlink.dump(os.path.join(directory, "%s.bin" % stlink.stlink.serial_number), freq)
+
+    with ThreadPoolExecutor(max_workers=max(len(stlinks), 1)) as workers:
+        results = list(workers.map(dump_one, stlinks))
+
+    return {stlink.stlink.serial_number: erased for stlink, erased in zip(stlinks, results)}
+
 
 if __name__ == "__main__":
     dir_path = os.path.dirname(os.path.realpath(__file__))
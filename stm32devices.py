@@ -1,3 +1,5 @@
+from records import PartDefinition
+
 # Device definitions, taken from https://github.com/pavelrevak/pystlink
 
 DEVICES = [
@@ -629,3 +631,112 @@ DEVICES = [
         ]
     },
 ]
+
+
+# STM32F42x/F43x and F469/F479: the 2 MB variants have two banks, each with the erase_sizes layout
+DUAL_BANK_DEV_IDS = (0x419, 0x434)
+
+
+def _flatten_devices(devices):
+    """
+    Expands the nested DEVICES table into one PartDefinition per concrete part
+    """
+    parts = []
+    for core in devices:
+        for family in core['devices']:
+            for part in family['devices']:
+                parts.append(PartDefinition(type=part['type'],
+                                            part_no=core['part_no'],
+                                            core=core['core'],
+                                            idcode_reg=core['idcode_reg'],
+                                            dev_id=family['dev_id'],
+                                            flash_size_reg=family['flash_size_reg'],
+                                            flash_driver=family['flash_driver'],
+                                            erase_sizes=family['erase_sizes'],
+                                            flash_size=part['flash_size'],
+                                            sram_size=part['sram_size'],
+                                            eeprom_size=part['eeprom_size'],
+                                            freq=part['freq']))
+    return tuple(parts)
+
+
+PARTS = _flatten_devices(DEVICES)
+
+
+def find_part(part_type):
+    """
+    Looks up a part definition by its type name (eg 'STM32F767xI')
+    :return: PartDefinition or None if the part is unknown
+    """
+    for part in PARTS:
+        if part.type == part_type:
+            return part
+    return None
+
+
+def find_parts(dev_id):
+    """
+    Gets every part definition sharing a device id (the 'chipid' reported by st-info)
+    :return: list of PartDefinition
+    """
+    return [part for part in PARTS if part.dev_id == dev_id]
+
+
+def part_family(chip_id, descr=''):
+    """
+    Works out the part family (eg 'F7', 'L0') of a probed chip
+    :param chip_id: the chip id reported by st-info
+    :param descr: the description reported by st-info, used when the chip id is unknown
+    """
+    parts = find_parts(chip_id)
+    if parts:
+        # Part types look like 'STM32F767xI'
+        return parts[0].type[5:7]
+    return descr[:2] if descr else None
+
+
+def sector_layout(part, flash_size=None):
+    """
+    Gets the (address offset, size) of each erasable sector of a part. The erase_sizes tables only
+    list the sectors of the smallest flash variant, so the last size is repeated to cover larger parts,
+    except on the dual bank parts in DUAL_BANK_DEV_IDS, where the whole table is repeated for bank 2.
+    :param part: PartDefinition of the target
+    :param flash_size: actual flash size in bytes, defaults to the part's nominal size
+    :return: list of (offset, size) tuples
+    """
+    if not part.erase_sizes:
+        raise ValueError("No erase sector information for %s" % part.type)
+
+    if flash_size is None:
+        flash_size = part.flash_size * 1024
+
+    bank_size = sum(part.erase_sizes)
+    if part.dev_id in DUAL_BANK_DEV_IDS and flash_size > bank_size:
+        if flash_size != 2 * bank_size:
+            raise ValueError("Unexpected flash size %d for dual bank part %s" % (flash_size, part.type))
+
+        return [(bank * bank_size + offset, size) for bank in range(2)
+                for offset, size in sector_layout(part, bank_size)]
+
+    sectors = []
+    offset = 0
+    index = 0
+    while offset < flash_size:
+        size = part.erase_sizes[min(index, len(part.erase_sizes) - 1)]
+        sectors.append((offset, size))
+        offset += size
+        index += 1
+
+    return sectors
+
+
+def sector_number(part, index):
+    """
+    Gets the number the flash controller uses for a sector (FLASH_CR.SNB on STM32FS parts). Sectors of the
+    second bank of dual bank parts are numbered from 0x10.
+    :param part: PartDefinition of the target
+    :param index: position of the sector in sector_layout()
+    """
+    if part.dev_id in DUAL_BANK_DEV_IDS and index >= len(part.erase_sizes):
+        return 0x10 | (index - len(part.erase_sizes))
+    return index
@@ -0,0 +1,175 @@
+/*
+ * Decompress-and-program stub for STM32 parts using the STM32FS flash driver (F2/F4/F7).
+ *
+ * Loaded into SRAM by compressed_transfer.CompressedWriter, which streams LZSS compressed blocks
+ * (see compression.py) into two mailbox slots. The stub works through the slots in turn: decompress
+ * into the output buffer, erase the sector if asked to, program and verify, then hand the slot back.
+ * The layout below must match compressed_transfer.py.
+ */
+#include <stdint.h>
+
+#define SRAM_BASE           0x20000000u
+#define STUB_AREA           0x1000u
+#define MAILBOX             (SRAM_BASE + STUB_AREA)
+#define SLOTS               (MAILBOX + 0x10u)
+#define SLOT_COUNT          2u
+#define SLOT_WORDS          8u
+
+#define STUB_MAGIC          0x42555453u     /* 'STUB' */
+
+#define SLOT_EMPTY          0u
+#define SLOT_READY          1u
+#define SLOT_DONE           2u
+
+#define FLAG_ERASE          (1u << 0)
+#define FLAG_RAW            (1u << 1)
+#define FLAG_SECTOR(flags)  (((flags) >> 8) & 0x1Fu)
+
+#define STATUS_VERIFY_FAIL  0x100u
+
+#define FLASH_KEYR          (*(volatile uint32_t *)0x40023C04u)
+#define FLASH_SR            (*(volatile uint32_t *)0x40023C0Cu)
+#define FLASH_CR            (*(volatile uint32_t *)0x40023C10u)
+
+#define SR_BSY              (1u << 16)
+#define SR_ERRORS           0xF2u
+#define CR_PG               (1u << 0)
+#define CR_SER              (1u << 1)
+#define CR_PSIZE_X32        (2u << 8)
+#define CR_STRT             (1u << 16)
+#define CR_LOCK             (1u << 31)
+
+struct slot {
+    volatile uint32_t state;
+    volatile uint32_t input;
+    volatile uint32_t compressed_length;
+    volatile uint32_t raw_length;
+    volatile uint32_t destination;
+    volatile uint32_t flags;
+    volatile uint32_t status;
+    volatile uint32_t reserved;
+};
+
+struct mailbox {
+    volatile uint32_t magic;
+    volatile uint32_t output;
+    volatile uint32_t reserved[2];
+    struct slot slots[SLOT_COUNT];
+};
+
+#define MAILBOX_PTR ((struct mailbox *)MAILBOX)
+
+static void barrier(void)
+{
+    __asm volatile ("dsb" ::: "memory");
+}
+
+static uint32_t wait_ready(void)
+{
+    while (FLASH_SR & SR_BSY) {
+    }
+
+    uint32_t errors = FLASH_SR & SR_ERRORS;
+    FLASH_SR = SR_ERRORS;
+    return errors;
+}
+
+static void decompress(const uint8_t *input, uint8_t *output, uint32_t size)
+{
+    uint32_t produced = 0;
+
+    while (produced < size) {
+        uint8_t flags = *input++;
+
+        for (uint32_t bit = 0; bit < 8 && produced < size; bit++) {
+            if (flags & (1u << bit)) {
+                uint32_t word = input[0] | (input[1] << 8);
+                uint32_t offset = (word >> 4) + 1;
+                uint32_t length = (word & 0xFu) + 3;
+                input += 2;
+
+                while (length-- && produced < size) {
+                    output[produced] = output[produced - offset];
+                    produced++;
+                }
+            } else {
+                output[produced++] = *input++;
+            }
+        }
+    }
+}
+
+static uint32_t program(uint32_t destination, const uint8_t *data, uint32_t length, uint32_t flags)
+{
+    uint32_t errors;
+
+    if (flags & FLAG_ERASE) {
+        FLASH_CR = CR_SER | (FLAG_SECTOR(flags) << 3) | CR_PSIZE_X32;
+        FLASH_CR |= CR_STRT;
+        barrier();
+        if ((errors = wait_ready()) != 0) {
+            return errors;
+        }
+    }
+
+    FLASH_CR = CR_PG | CR_PSIZE_X32;
+    for (uint32_t offset = 0; offset < length; offset += 4) {
+        uint32_t word = 0xFFFFFFFFu;
+        for (uint32_t byte = 0; byte < 4 && offset + byte < length; byte++) {
+            word &= ~(0xFFu << (8 * byte));
+            word |= (uint32_t)data[offset + byte] << (8 * byte);
+        }
+
+        *(volatile uint32_t *)(destination + offset) = word;
+        barrier();
+        if ((errors = wait_ready()) != 0) {
+            FLASH_CR = 0;
+            return errors;
+        }
+    }
+    FLASH_CR = 0;
+
+    for (uint32_t offset = 0; offset < length; offset++) {
+        if (*(volatile uint8_t *)(destination + offset) != data[offset]) {
+            return STATUS_VERIFY_FAIL;
+        }
+    }
+
+    return 0;
+}
+
+void stub_main(void)
+{
+    struct mailbox *mailbox = MAILBOX_PTR;
+    uint8_t *output = (uint8_t *)mailbox->output;
+
+    if (FLASH_CR & CR_LOCK) {
+        FLASH_KEYR = 0x45670123u;
+        FLASH_KEYR = 0xCDEF89ABu;
+    }
+
+    mailbox->magic = STUB_MAGIC;
+
+    for (uint32_t index = 0;; index = (index + 1) % SLOT_COUNT) {
+        struct slot *slot = &mailbox->slots[index];
+
+        while (slot->state != SLOT_READY) {
+        }
+
+        const uint8_t *data = (const uint8_t *)slot->input;
+        if (!(slot->flags & FLAG_RAW)) {
+            decompress(data, output, slot->raw_length);
+            data = output;
+        }
+
+        slot->status = program(slot->destination, data, slot->raw_length, slot->flags);
+        slot->state = SLOT_DONE;
+    }
+}
+
+/* Minimal vector table: the host reads the initial stack pointer and entry point from here */
+__attribute__((section(".vectors"), used))
+static const uint32_t vectors[2] = {
+    SRAM_BASE + STUB_AREA,
+    (uint32_t)stub_main,
+};
@@ -0,0 +1,105 @@
+import time
+import types
+import asyncio
+import unittest
+
+import capture
+from capture import LogCapture, RingBuffer
+from tools import FlashError
+
+
+class RingBufferTest(unittest.TestCase):
+    def read(self, ring):
+        views, position = ring.read_views()
+        data = b''.join(bytes(view) for view in views)
+        ring.consume(position)
+        return data
+
+    def test_wraps(self):
+        ring = RingBuffer(8)
+        ring.write(b'abcdef')
+        self.assertEqual(self.read(ring), b'abcdef')
+
+        ring.write(b'ghijk')
+        views, _ = ring.read_views()
+        self.assertEqual(len(views), 2)
+        self.assertEqual(self.read(ring), b'ghijk')
+        self.assertEqual(len(ring), 0)
+
+    def test_drops_oldest(self):
+        ring = RingBuffer(8)
+        ring.write(b'0123456789')
+        self.assertEqual(ring.dropped, 2)
+        self.assertEqual(self.read(ring), b'23456789')
+
+    def test_receive_into(self):
+        ring = RingBuffer(8)
+        ring.write(b'12345678')
+
+        # A full ring makes room by dropping an eighth of its capacity
+        view = ring.write_view()
+        self.assertEqual((len(view), ring.dropped), (1, 1))
+        view[0] = ord('9')
+        ring.commit(1)
+        self.assertEqual(self.read(ring), b'23456789')
+
+
+class FailingSession:
+    """
+    An OpenOCD session on which no RTT control block is ever found
+    """
+    def __init__(self, device):
+        self.closed = False
+
+    def command(self, command, message=None):
+        if command.startswith('set _end'):
+            raise FlashError(message)
+        return ''
+
+    def close(self):
+        self.closed = True
+
+
+class LogCaptureTest(unittest.TestCase):
+    def test_failed_start_closes_session(self):
+        sessions = []
+
+        def open_session(device):
+            sessions.append(FailingSession(device))
+            return sessions[-1]
+
+        stlink = types.SimpleNamespace(stlink=types.SimpleNamespace(name='fake'), sram_size=0x20000)
+        open_session_before, capture.OpenOCDSession = capture.OpenOCDSession, open_session
+
+        async def start():
+            async with LogCapture(stlink):
+                pass
+
+        try:
+            with self.assertRaises(FlashError):
+                asyncio.run(start())
+        finally:
+            capture.OpenOCDSession = open_session_before
+
+        self.assertTrue(sessions[0].closed)
+
+    def test_bad_options(self):
+        with self.assertRaises(ValueError):
+            LogCapture(None, source='uart')
+        with self.assertRaises(ValueError):
+            LogCapture(None, source=capture.SWO)
+
+
+if __name__ == '__main__':
+    # Throughput of receiving into the ring and reading it back without copies
+    ring = RingBuffer()
+    block = b'x' * 1024
+    start = time.perf_counter()
+    for _ in range(100000):
+        view = ring.write_view()
+        count = min(len(view), len(block))
+        view[:count] = block[:count]
+        ring.commit(count)
+        views, position = ring.read_views()
+        ring.consume(position)
+    print("Moved %.0f MB through the ring in %.2f s" % (ring.head / 1e6, time.perf_counter() - start))
@@ -0,0 +1,76 @@
+import os
+import shutil
+import unittest
+import subprocess
+
+from compressed_transfer import STUB_FILE, CompressedWriter
+from compression import compress, decompress
+from simulator import SimulatedTarget
+from stm32devices import find_parts, sector_layout
+
+
+TEST_BINARY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'TestBinaries', 'STM32F7xxx', 'ChimeraDevelopment.bin')
+
+SRAM_SIZE = 256 * 1024
+
+
+def write(binary_file, compressed, **rates):
+    """
+    Writes a binary onto a simulated STM32F76x through the stub
+    :return: (SimulatedTarget, CompressedWriter.write() statistics)
+    """
+    sectors = sector_layout(find_parts(0x451)[0], 2 * 1024 * 1024)
+    target = SimulatedTarget(SRAM_SIZE, sectors, **rates)
+    return target, CompressedWriter(target, sectors, SRAM_SIZE, 'simulated').write(binary_file, compressed=compressed)
+
+
+def benchmark(link_rate=80e3, erase_rate=1e6):
+    """
+    :return: (raw statistics, compressed statistics) for the test binary over a slow SWD link
+    """
+    return tuple(write(TEST_BINARY, compressed, link_rate=link_rate, erase_rate=erase_rate)[1]
+                 for compressed in (False, True))
+
+
+class CompressionTest(unittest.TestCase):
+    def test_round_trip(self):
+        for data in (b'', b'a', bytes(range(256)) * 40, os.urandom(5000), b'abc' * 3000):
+            self.assertEqual(decompress(compress(data), len(data)), data)
+
+    def test_firmware_compresses(self):
+        with open(TEST_BINARY, 'rb') as file:
+            image = file.read()
+        self.assertLess(len(compress(image)), 0.8 * len(image))
+
+
+class CompressedWriterTest(unittest.TestCase):
+    def test_writes_image(self):
+        with open(TEST_BINARY, 'rb') as file:
+            image = file.read()
+
+        fast = dict(link_rate=50e6, flash_rate=50e6, erase_rate=50e6, latency=0)
+        for compressed in (False, True):
+            target, stats = write(TEST_BINARY, compressed, **fast)
+            self.assertEqual(bytes(target.flash[:len(image)]), image)
+            self.assertEqual(stats['raw_bytes'], len(image))
+            if compressed:
+                self.assertLess(stats['sent_bytes'], 0.8 * len(image))
+            else:
+                self.assertEqual(stats['sent_bytes'], len(image))
+
+
+class StubBuildTest(unittest.TestCase):
+    @unittest.skipUnless(shutil.which('arm-none-eabi-gcc'), "needs the arm-none-eabi toolchain")
+    def test_stub_builds_and_fits(self):
+        # The simulator emulates the stub's protocol in Python, so this is the only check of the real stub
+        result = subprocess.run(['make', '-C', os.path.dirname(STUB_FILE), 'check'], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        self.assertEqual(result.returncode, 0, result.stdout.decode("utf-8", "replace"))
+
+
+if __name__ == '__main__':
+    raw, compressed = benchmark()
+    print("Raw: %d bytes in %.2f s, compressed: %d bytes (%.0f%%) in %.2f s" %
+          (raw['sent_bytes'], raw['seconds'], compressed['sent_bytes'], 100 * compressed['ratio'],
+           compressed['seconds']))
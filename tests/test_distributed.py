@@ -0,0 +1,136 @@
+import os
+import time
+import tempfile
+import unittest
+import threading
+import collections
+
+from distributed import Agent, Coordinator, _AgentHandler, _request
+import inventory
+from prestage import Job
+from simulator import SimulatedBackend, SimulatedProbe
+
+
+def start_agents(hosts=3, probes_per_host=4, chip_ids=(0x451, 0x451, 0x451, 0x421), rate=2e6):
+    """
+    Agents on localhost, each serving its own simulated probes
+    :return: list of started Agents
+    """
+    return [Agent(SimulatedBackend([SimulatedProbe(host * 100 + index, chip_ids[index % len(chip_ids)], rate=rate)
+                                    for index in range(probes_per_host)]), port=0).start()
+            for host in range(hosts)]
+
+
+class DistributedTest(unittest.TestCase):
+    def setUp(self):
+        self.agents = start_agents(rate=200e3)
+        self.coordinator = Coordinator([agent.url for agent in self.agents])
+
+        with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as file:
+            file.write(os.urandom(64 * 1024))
+        self.image = file.name
+
+        # Count the images each agent receives
+        self.puts = collections.Counter()
+        self._do_put = _AgentHandler.do_PUT
+
+        def counting(handler):
+            self.puts[handler.server.agent.url] += 1
+            return self._do_put(handler)
+        _AgentHandler.do_PUT = counting
+
+    def tearDown(self):
+        _AgentHandler.do_PUT = self._do_put
+        for agent in self.agents:
+            agent.close()
+        os.remove(self.image)
+
+    def test_refresh(self):
+        self.assertEqual(self.coordinator.refresh(), 12)
+        self.assertEqual(len(self.coordinator.inventory.find(chip_id=0x421, attached=True)), 3)
+
+    def test_images_sent_once_per_host(self):
+        self.coordinator.refresh()
+        results = self.coordinator.run_all([Job(self.image, 0x451) for _ in range(18)])
+
+        self.assertFalse([result for result in results if isinstance(result, Exception)])
+        self.assertEqual(dict(self.puts), {agent.url: 1 for agent in self.agents})
+        self.assertEqual(sum(probe.flash_count for agent in self.agents for probe in agent.backend.probes.values()),
+                         18)
+
+    def test_least_loaded_placement(self):
+        self.coordinator.refresh()
+        results = self.coordinator.run_all([Job(self.image, 0x451) for _ in range(3)])
+
+        # Every host has idle boards, so each job goes to a different one
+        self.assertEqual(sorted(result['host'] for result in results), sorted(agent.url for agent in self.agents))
+
+    def test_unknown_chip(self):
+        self.coordinator.refresh()
+        with self.assertRaises(ValueError):
+            self.coordinator.run(Job(self.image, 0x999))
+
+    def test_flash_rejects_paths(self):
+        status, _ = _request('POST', self.agents[0].url + '/flash', {'serial': 0, 'image_hash': '../../etc/passwd'})
+        self.assertEqual(status, 400)
+
+    def test_waiting_job_fails_when_boards_detach(self):
+        self.coordinator.refresh()
+        for record in self.coordinator.inventory.find(chip_id=0x421):
+            self.coordinator.inventory.set_state(record.serial, inventory.BUSY)
+
+        errors = []
+
+        def run():
+            try:
+                self.coordinator.run(Job(self.image, 0x421))
+            except ValueError as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        time.sleep(0.2)
+
+        for agent in self.agents:
+            for serial in [serial for serial, probe in agent.backend.probes.items() if probe.record.chipid == 0x421]:
+                agent.backend.probes.pop(serial)
+        self.coordinator.refresh(rediscover=True)
+
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+    def test_busy_boards_kept_on_rediscovery(self):
+        agent = self.agents[0]
+        serial = next(iter(agent.boards))
+        agent.busy.add(serial)
+        agent.backend.probes.pop(serial)
+
+        self.coordinator.refresh(rediscover=True)
+        self.assertIn(serial, agent.boards)
+        self.assertIn((serial, True), [(record.serial, busy) for record, busy in agent.list_boards()])
+
+    def test_close_removes_image_dir(self):
+        agent = self.agents[0]
+        self.assertTrue(os.path.isdir(agent.image_dir))
+        agent.close()
+        self.agents.remove(agent)
+        self.assertFalse(os.path.exists(agent.image_dir))
+
+
+if __name__ == '__main__':
+    # 60 jobs of a 1 MB image over three hosts of four probes
+    agents = start_agents()
+    with tempfile.NamedTemporaryFile(suffix='.bin') as image:
+        image.write(os.urandom(1024 * 1024))
+        image.flush()
+
+        coordinator = Coordinator([agent.url for agent in agents])
+        coordinator.refresh()
+        start = time.perf_counter()
+        results = coordinator.run_all([Job(image.name, 0x451) for _ in range(60)])
+        print("Flashed %d boards in %.1f s" % (len([result for result in results if isinstance(result, dict)]),
+                                               time.perf_counter() - start))
+
+    for agent in agents:
+        agent.close()
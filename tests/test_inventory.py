@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+
+import inventory
+from inventory import Inventory
+from records import ProbeRecord
+
+
+def probe(serial, chip_id=0x451, usb_port=None, name=None):
+    return ProbeRecord(serial, 'stm32f7x', 2 * 1024 * 1024, 512 * 1024, chip_id, 'F76xxx', usb_port, name)
+
+
+def benchmark(count=5000, queries=1000):
+    """
+    :return: seconds taken by queries indexed lookups over an inventory of count boards
+    """
+    board_inventory = Inventory(':memory:')
+    board_inventory.sync_records([probe(serial, 0x451 if serial % 2 else 0x421, '1-%d' % serial)
+                                  for serial in range(count)])
+
+    start = time.perf_counter()
+    for serial in range(queries):
+        board_inventory.get(serial)
+        board_inventory.find(usb_port='1-%d' % serial)
+    return time.perf_counter() - start
+
+
+class InventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.inventory = Inventory(':memory:')
+
+    def tearDown(self):
+        self.inventory.close()
+
+    def test_find(self):
+        self.inventory.sync_records([probe(1), probe(2, 0x421, '1-2'), probe(3)])
+        self.inventory.mark_flashed(3, 'abc')
+
+        self.assertEqual([record.serial for record in self.inventory.find(chip_id=0x451)], [1, 3])
+        self.assertEqual(self.inventory.find(usb_port='1-2'), [probe(2, 0x421, '1-2')])
+        self.assertEqual([record.serial for record in self.inventory.find(image_hash='abc')], [3])
+        self.assertIsNone(self.inventory.get(4))
+
+    def test_available(self):
+        self.inventory.sync_records([probe(1), probe(2), probe(3)])
+        self.inventory.set_state(2, inventory.BUSY)
+        self.inventory.sync_records([probe(1), probe(2)])
+
+        self.assertEqual([record.serial for record in self.inventory.available('F7')], [1])
+
+        with self.assertRaises(ValueError):
+            self.inventory.set_state(1, 'broken')
+
+    def test_import_json(self):
+        self.inventory.add_probe(probe(1))
+
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = []
+            for record in (probe(1, name='old name'), probe(2, name='slot 2'), probe(3, name='x' * 40)):
+                filenames.append(os.path.join(directory, '%d.json' % record.serial))
+                with open(filenames[-1], 'w') as file:
+                    json.dump(record.to_dict(), file)
+
+            self.assertEqual(self.inventory.import_json(filenames), 3)
+
+        # Imports never detach a board that is plugged in, and only fill in missing names
+        self.assertEqual([record.serial for record in self.inventory.find(attached=True)], [1])
+        self.assertEqual(self.inventory.get(1).name, 'old name')
+        self.assertEqual(self.inventory.get(2).name, 'slot 2')
+        self.assertEqual(self.inventory.get(3).name, 'x' * 40)
+
+        with self.assertRaises(ValueError):
+            self.inventory.import_json(['board.txt'])
+
+    def test_threads(self):
+        self.inventory.sync_records([probe(serial) for serial in range(20)])
+        errors = []
+
+        def work():
+            try:
+                for count in range(200):
+                    self.inventory.mark_flashed(count % 20, 'image %d' % count)
+                    self.inventory.find(chip_id=0x451, attached=True)
+                    self.inventory.set_state(count % 20, inventory.BUSY if count % 2 else inventory.IDLE)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=work) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    print("1000 serial and USB port lookups over 5000 boards: %.3f s" % benchmark())
@@ -0,0 +1,88 @@
+import time
+import threading
+import unittest
+
+from performance import FLASH, TUNE, PerformanceHistory, timed
+
+
+def fill(history, serial, values, operation=FLASH, image_size=1000, start=0):
+    """
+    Records one run per throughput in values (bytes/s), oldest first
+    """
+    for index, value in enumerate(values):
+        history.record(operation, image_size / value, serial, 0x451, image_size, timestamp=start + index)
+
+
+def benchmark(boards=200, runs=100):
+    """
+    :return: seconds taken to find regressions over boards with runs timings each
+    """
+    with PerformanceHistory(':memory:') as history:
+        for serial in range(boards):
+            fill(history, serial, [1000.0] * runs)
+
+        start = time.perf_counter()
+        history.regressions()
+        return time.perf_counter() - start
+
+
+class PerformanceHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.history = PerformanceHistory(':memory:')
+
+    def tearDown(self):
+        self.history.close()
+
+    def test_regressions(self):
+        fill(self.history, 1, [1000.0] * 20 + [500.0] * 5)
+        fill(self.history, 2, [1000.0] * 20 + [900.0] * 5)
+        fill(self.history, 3, [500.0] * 5)
+
+        regressions = self.history.regressions()
+        self.assertEqual([regression.serial for regression in regressions], ['1'])
+        self.assertAlmostEqual(regressions[0].ratio, 0.5)
+
+    def test_operations_kept_apart(self):
+        # Deliberately slow tuning runs are not flash regressions
+        fill(self.history, 1, [1000.0] * 20)
+        fill(self.history, 1, [100.0] * 5, TUNE, start=100)
+
+        self.assertEqual(self.history.regressions(), [])
+        self.assertEqual(len(self.history.runs(TUNE, 1)), 5)
+
+    def test_slowest(self):
+        fill(self.history, 1, [1000.0] * 3)
+        fill(self.history, 2, [200.0] * 3)
+        with self.assertRaises(RuntimeError), self.history.timed(FLASH, 2):
+            raise RuntimeError
+
+        serials = [(serial, runs, failures) for serial, _, runs, failures, _ in self.history.slowest()]
+        self.assertEqual(serials, [('2', 3, 1), ('1', 3, 0)])
+
+    def test_optional_history(self):
+        with timed(None, FLASH, serial=1):
+            pass
+
+    def test_threads(self):
+        errors = []
+
+        def work(serial):
+            try:
+                for _ in range(200):
+                    with self.history.timed(FLASH, serial, image_size=100):
+                        pass
+                    self.history.runs(FLASH, serial, 25)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=work, args=(serial,)) for serial in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    print("Regressions over 200 boards of 100 runs: %.3f s" % benchmark())
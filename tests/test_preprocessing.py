@@ -0,0 +1,107 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+from preprocessing import ImagePreprocessor, WritePlan, build_plan
+from stlink import flash_changed
+
+SECTOR_SIZE = 16 * 1024
+SECTORS = [(index * SECTOR_SIZE, SECTOR_SIZE) for index in range(16)]
+
+
+class FakeSTLink:
+    """
+    Records the plans it is asked to flash
+    """
+    def __init__(self, serial):
+        self.stlink = type('Device', (), {'serial_number': serial, 'name': str(serial)})
+        self.sectors = SECTORS
+        self.plans = []
+
+    def flash_plan(self, plan, freq=None):
+        flash_changed(self.stlink.serial_number)
+        self.plans.append(plan)
+
+    def erase(self):
+        flash_changed(self.stlink.serial_number)
+
+
+class ImageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image = os.urandom(5 * SECTOR_SIZE + 100)
+        self.first = self.write('first.bin', self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+
+class PlanTest(ImageTestCase):
+    def test_full_plan(self):
+        plan = build_plan(self.first, "0x08000000", SECTORS)
+        self.assertEqual(plan.writes, [(0, len(self.image))])
+        self.assertEqual(len(plan.sector_crcs), 6)
+        self.assertIn('6 region', repr(WritePlan('a.bin', "0x08000000", None, None, [(0, 1)] * 6)))
+
+    def test_delta(self):
+        changed = bytearray(self.image)
+        changed[SECTOR_SIZE + 5] ^= 0xFF
+        changed[3 * SECTOR_SIZE] ^= 0xFF
+        changed[4 * SECTOR_SIZE] ^= 0xFF
+        second = self.write('second.bin', changed)
+
+        previous = build_plan(self.first, "0x08000000", SECTORS)
+        plan = build_plan(second, "0x08000000", SECTORS, previous.sector_crcs)
+        self.assertEqual(plan.writes, [(SECTOR_SIZE, SECTOR_SIZE), (3 * SECTOR_SIZE, 2 * SECTOR_SIZE)])
+
+    def test_link_address(self):
+        plan = build_plan(self.first, "0x08008000", SECTORS)
+        self.assertEqual(plan.writes, [(2 * SECTOR_SIZE, len(self.image))])
+
+    def test_too_large(self):
+        large = self.write('large.bin', bytes(len(SECTORS) * SECTOR_SIZE + 1))
+        with self.assertRaises(ValueError):
+            build_plan(large, "0x08000000", SECTORS)
+
+
+class FlashAllTest(ImageTestCase):
+    def test_flash_all(self):
+        stlink = FakeSTLink(1001)
+        large = self.write('large.bin', bytes(len(SECTORS) * SECTOR_SIZE + 1))
+
+        with ImagePreprocessor(2) as preprocessor, contextlib.redirect_stdout(None):
+            results = preprocessor.flash_all([(stlink, self.first, "0x08000000"), (stlink, large, "0x08000000"),
+                                              (stlink, self.first, "0x08000000")])
+            self.assertEqual(results, [True, False, True])
+            self.assertEqual([plan.writes for plan in stlink.plans], [[(0, len(self.image))], []])
+
+            # Anything else writing the board means the next image has to be written in full
+            stlink.erase()
+            self.assertEqual(preprocessor.flash_all([(stlink, self.first, "0x08000000")]), [True])
+            self.assertEqual(stlink.plans[-1].writes, [(0, len(self.image))])
+
+
+if __name__ == '__main__':
+    # Planning a 2 MB image against its previous version, as done off the flash path
+    with tempfile.TemporaryDirectory() as directory:
+        sectors = [(index * 128 * 1024, 128 * 1024) for index in range(16)]
+        image = bytearray(os.urandom(2 * 1024 * 1024))
+        paths = []
+        for name in ('first.bin', 'second.bin'):
+            paths.append(os.path.join(directory, name))
+            with open(paths[-1], 'wb') as file:
+                file.write(image)
+            image[len(image) // 2] ^= 0xFF
+
+        start = time.perf_counter()
+        plan = build_plan(paths[1], "0x08000000", sectors, build_plan(paths[0], "0x08000000", sectors).sector_crcs)
+        print("Planned 2 MB delta in %.3f s, %d bytes to write" % (time.perf_counter() - start, plan.write_size))
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+import contextlib
+
+from records import ProbeRecord, RecordArray, USBRecord
+from stlink import STLink_USBInterface
+from stm32devices import find_parts, sector_layout, sector_number
+
+
+def probe(serial=0x066DFF535254887767054237, name=None):
+    return ProbeRecord(serial, 'stm32f7x', 2 * 1024 * 1024, 512 * 1024, 0x451, 'F76xxx', '1-1.4', name)
+
+
+def benchmark(count=100000):
+    """
+    Builds the same probes as nested dictionaries and as a RecordArray
+    :return: (bytes held by the dictionaries, bytes held by the RecordArray, seconds to iterate the array)
+    """
+    records = [probe(serial) for serial in range(count)]
+    dictionaries = [record.to_dict() for record in records]
+    dictionary_bytes = sum(sys.getsizeof(dictionary) + sum(sys.getsizeof(value) for value in dictionary.values())
+                           for dictionary in dictionaries)
+
+    array = RecordArray(ProbeRecord)
+    array.extend(records)
+
+    start = time.perf_counter()
+    for _ in array:
+        pass
+    return dictionary_bytes, len(array.tobytes()), time.perf_counter() - start
+
+
+class ProbeRecordTest(unittest.TestCase):
+    def test_pack_round_trip(self):
+        record = probe(name='bench-3')
+        self.assertEqual(ProbeRecord.unpack(record.pack()), record)
+        self.assertEqual(ProbeRecord.from_dict(record.to_dict()), record)
+
+    def test_long_names_truncated(self):
+        unpacked = ProbeRecord.unpack(probe(name='é' * 20).pack())
+        self.assertEqual(unpacked.name, 'é' * 16)
+
+    def test_long_fields_rejected(self):
+        with self.assertRaises(ValueError):
+            ProbeRecord(1, 'x' * 33, 0, 0, 0x451, '').pack()
+
+
+class RecordArrayTest(unittest.TestCase):
+    def test_list_operations(self):
+        array = RecordArray(USBRecord)
+        array.extend(USBRecord(1, address, 0x0483, 0x3748, 'STLink') for address in range(5))
+
+        self.assertEqual(len(array), 5)
+        self.assertEqual(array[-1].address, 4)
+        self.assertEqual(array[0].port, '001:000')
+
+        array[1] = USBRecord(2, 9, 0x0483, 0x374b)
+        self.assertEqual([record.bus for record in array], [1, 2, 1, 1, 1])
+
+        with self.assertRaises(IndexError):
+            array[5]
+
+    def test_save_load(self):
+        array = RecordArray(ProbeRecord)
+        array.extend(probe(serial, 'board %d' % serial) for serial in range(3))
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'probes.bin')
+            array.save(filename)
+            self.assertEqual(list(RecordArray.load(ProbeRecord, filename)), list(array))
+
+    def test_bad_buffer(self):
+        with self.assertRaises(ValueError):
+            RecordArray(ProbeRecord, b'\x00' * (ProbeRecord.STRUCT.size + 1))
+
+
+class DeviceFileTest(unittest.TestCase):
+    def test_save_load_device(self):
+        usb_interface = STLink_USBInterface()
+        usb_interface.attach_device(probe())
+
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(None):
+            filename = os.path.join(directory, 'board.json')
+            usb_interface.save_device('rack1-slot4', filename)
+
+            loaded = STLink_USBInterface()
+            loaded.load_device(filename)
+
+        self.assertEqual(loaded.attached_device, probe(name='rack1-slot4'))
+
+    def test_save_device_rejects(self):
+        usb_interface = STLink_USBInterface()
+        usb_interface.attach_device(probe())
+
+        with self.assertRaises(ValueError):
+            usb_interface.save_device('x' * 33, 'board.json')
+        with self.assertRaises(ValueError):
+            usb_interface.save_device('board', 'board.txt')
+
+
+class SectorLayoutTest(unittest.TestCase):
+    def test_dual_bank(self):
+        part = find_parts(0x419)[0]
+        sectors = sector_layout(part, 2 * 1024 * 1024)
+
+        self.assertEqual(len(sectors), 24)
+        self.assertEqual(sectors[12], (1024 * 1024, 16 * 1024))
+        self.assertEqual(sum(size for _, size in sectors), 2 * 1024 * 1024)
+        self.assertEqual(sector_number(part, 11), 11)
+        self.assertEqual(sector_number(part, 12), 0x10)
+
+    def test_unsupported_size(self):
+        with self.assertRaises(ValueError):
+            sector_layout(find_parts(0x419)[0], 3 * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    dictionary_bytes, array_bytes, seconds = benchmark()
+    print("Dictionaries: %.1f MB, RecordArray: %.1f MB, iterated in %.2f s" %
+          (dictionary_bytes / 1e6, array_bytes / 1e6, seconds))
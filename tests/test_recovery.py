@@ -0,0 +1,139 @@
+import os
+import time
+import types
+import tempfile
+import unittest
+import contextlib
+
+import tools
+from recovery import RecoveryEngine, RecoveryPolicy, RETRY, RESET, REENUMERATE
+from stlink import STLink
+from tools import FlashError, NOT_HALTED, PROBE_LOST, TIMEOUT, UNKNOWN, VERIFY_MISMATCH, classify_failure, \
+    run_command
+
+SECTOR_SIZE = 16 * 1024
+
+# Retry at once rather than after the default delays
+POLICIES = {failure: RecoveryPolicy(retries=2, action=action) for failure, action in
+            ((PROBE_LOST, REENUMERATE), (NOT_HALTED, RESET), (VERIFY_MISMATCH, RETRY))}
+
+
+class FakeDevice:
+    name = 'fake'
+    serial_number = 1
+
+    def __init__(self):
+        self.attached_device = types.SimpleNamespace(usb_port='001:002')
+        self.ports = []     # what each get_port_from_serial() call finds
+
+    @property
+    def port(self):
+        return self.attached_device.usb_port
+
+    def get_port_from_serial(self, serial):
+        return self.ports.pop(0) if self.ports else None
+
+
+class FakeSTLink:
+    """
+    Writes plans region by region like STLink.flash_plan(), failing the writes listed in failures
+    """
+    chunks = STLink.chunks
+
+    def __init__(self, failures=(), reset_failures=()):
+        self.stlink = FakeDevice()
+        self.sectors = [(index * SECTOR_SIZE, SECTOR_SIZE) for index in range(16)]
+        self.failures = list(failures)              # (offset, failure), in the order they happen
+        self.reset_failures = list(reset_failures)  # failure of each reset that fails
+        self.written = []
+        self.resets = 0
+
+    def flash_plan(self, plan, freq=None):
+        for offset, size in plan.writes:
+            if self.failures and self.failures[0][0] == offset:
+                raise FlashError("Failed writing 0x%x" % offset, self.failures.pop(0)[1], offset=offset)
+            self.written.append((offset, size))
+
+    def reset(self):
+        self.resets += 1
+        if self.reset_failures:
+            raise FlashError("Failed resetting", self.reset_failures.pop(0))
+
+
+def flash(stlink, size=8 * SECTOR_SIZE, chunk_size=2 * SECTOR_SIZE):
+    """
+    Flashes a blank image of size bytes through a RecoveryEngine
+    """
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(None):
+        binary_file = os.path.join(directory, 'image.bin')
+        with open(binary_file, 'wb') as file:
+            file.write(bytes(size))
+        RecoveryEngine(stlink, POLICIES).flash(binary_file, chunk_size=chunk_size)
+
+
+class RecoveryEngineTest(unittest.TestCase):
+    def test_resumes_from_failed_region(self):
+        stlink = FakeSTLink(failures=[(4 * SECTOR_SIZE, VERIFY_MISMATCH)])
+        flash(stlink)
+
+        # Regions before the failure are not written again
+        self.assertEqual(stlink.written, [(offset * SECTOR_SIZE, 2 * SECTOR_SIZE) for offset in (0, 2, 4, 6)])
+
+    def test_gives_up(self):
+        stlink = FakeSTLink(failures=[(0, VERIFY_MISMATCH)] * 3)
+        with self.assertRaises(FlashError):
+            flash(stlink)
+
+        stlink = FakeSTLink(failures=[(0, UNKNOWN)])
+        with self.assertRaises(FlashError):
+            flash(stlink)
+        self.assertEqual(stlink.written, [])
+
+    def test_reset_failure_is_an_attempt(self):
+        stlink = FakeSTLink(failures=[(0, NOT_HALTED)], reset_failures=[NOT_HALTED])
+        flash(stlink)
+        self.assertEqual(stlink.resets, 2)
+        self.assertEqual(len(stlink.written), 4)
+
+    def test_probe_returns_late(self):
+        stlink = FakeSTLink(failures=[(0, PROBE_LOST)])
+        stlink.stlink.ports = [None, '001:005']
+        flash(stlink)
+        self.assertEqual(len(stlink.written), 4)
+        self.assertEqual(stlink.stlink.port, '001:005')
+
+        stlink = FakeSTLink(failures=[(0, PROBE_LOST)])
+        with self.assertRaises(FlashError) as raised:
+            flash(stlink)
+        self.assertEqual(raised.exception.failure, PROBE_LOST)
+
+
+class ToolsTest(unittest.TestCase):
+    def test_classify_failure(self):
+        self.assertEqual(classify_failure("Couldn't find any ST-Link devices"), PROBE_LOST)
+        self.assertEqual(classify_failure("target not halted"), NOT_HALTED)
+        self.assertEqual(classify_failure("Flash verification failed"), VERIFY_MISMATCH)
+        self.assertEqual(classify_failure("...\n" + tools.TIMED_OUT), TIMEOUT)
+        self.assertEqual(classify_failure("something else"), UNKNOWN)
+
+    @unittest.skipUnless(os.name == 'posix', "runs a shell command")
+    def test_echoed_timeout_kills_children(self):
+        timeout = tools.COMMAND_TIMEOUT
+        tools.COMMAND_TIMEOUT = 1
+        try:
+            start = time.perf_counter()
+            output = run_command("export STLINK_DEVICE=001:002; sleep 10; echo done", shell=True, echo=True)
+        finally:
+            tools.COMMAND_TIMEOUT = timeout
+
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(classify_failure(output.stdout.decode("utf-8")), TIMEOUT)
+
+
+if __name__ == '__main__':
+    # Bytes written for a 1 MB image that fails three quarters of the way through, resumed vs started over
+    stlink = FakeSTLink(failures=[(48 * SECTOR_SIZE, VERIFY_MISMATCH)])
+    stlink.sectors = [(index * SECTOR_SIZE, SECTOR_SIZE) for index in range(64)]
+    flash(stlink, size=64 * SECTOR_SIZE, chunk_size=4 * SECTOR_SIZE)
+    resumed = sum(size for _, size in stlink.written)
+    print("Resumed: %d KB written, started over: %d KB" % (resumed // 1024, (48 + 64) * SECTOR_SIZE // 1024))
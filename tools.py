@@ -0,0 +1,112 @@
+import os
+import re
+import sys
+import signal
+import threading
+import subprocess
+
+
+# Timeout (seconds) for a single st-flash or OpenOCD command
+COMMAND_TIMEOUT = 120
+TIMED_OUT = "command timed out"
+
+# Classes of failure, see classify_failure()
+PROBE_LOST = 'probe_lost'
+NOT_HALTED = 'not_halted'
+VERIFY_MISMATCH = 'verify_mismatch'
+TIMEOUT = 'timeout'
+UNKNOWN = 'unknown'
+
+_FAILURE_PATTERNS = [
+    (PROBE_LOST, re.compile(r"couldn't find any st-link|found 0 stlink|libusb_error|no stlink|"
+                            r"failed to (connect|enter swd mode)|usb .*(error|failed)", re.I)),
+    (NOT_HALTED, re.compile(r"not halted|failed to halt|core.*running|target.*busy", re.I)),
+    (VERIFY_MISMATCH, re.compile(r"verif\w* .*fail|fail\w* .*verif|mismatch", re.I)),
+]
+
+
+def classify_failure(output):
+    """
+    Works out why an st-flash or OpenOCD command failed from the text it printed
+    :param output: combined stdout/stderr of the command
+    :return: one of PROBE_LOST, NOT_HALTED, VERIFY_MISMATCH, TIMEOUT or UNKNOWN
+    """
+    if output.endswith(TIMED_OUT):
+        return TIMEOUT
+
+    for failure, pattern in _FAILURE_PATTERNS:
+        if pattern.search(output):
+            return failure
+
+    return UNKNOWN
+
+
+class FlashError(RuntimeError):
+    """
+    Raised when an st-flash or OpenOCD command fails
+    :param failure: the class of failure, see classify_failure()
+    :param output: what the command printed
+    :param offset: for writes, the offset (relative to FLASH_BASE) of the region that failed. Everything
+                   before it was written successfully.
+    """
+    def __init__(self, message, failure=UNKNOWN, output='', offset=None):
+        super().__init__(message)
+        self.failure = failure
+        self.output = output
+        self.offset = offset
+
+
+def run_command(command, shell=False, echo=False):
+    """
+    Runs one of the external tools, capturing its combined stdout/stderr. A command that hangs is killed
+    after COMMAND_TIMEOUT seconds and reported as failed, with output ending in TIMED_OUT.
+    :param command: command string (with shell=True) or argument list
+    :param echo: also print the output as it arrives, eg to show st-flash's progress
+    :return: subprocess.CompletedProcess
+    """
+    if echo:
+        return _run_echoed(command, shell)
+
+    try:
+        return subprocess.run(command, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              timeout=COMMAND_TIMEOUT)
+    except subprocess.TimeoutExpired as timeout:
+        stdout = (timeout.output or b'') + ("\n" + TIMED_OUT).encode("utf-8")
+        return subprocess.CompletedProcess(command, -1, stdout)
+
+
+def _run_echoed(command, shell):
+    # In its own session, so a timeout kills the tool along with the shell started to run it. Killing only
+    # the shell would leave the tool holding the pipe open, and the read below would never end.
+    process = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(COMMAND_TIMEOUT, kill)
+    timer.start()
+    output = []
+    try:
+        # read1() returns whatever is available, so progress lines ending in \r show up straight away
+        for block in iter(lambda: process.stdout.read1(4096), b''):
+            output.append(block)
+            sys.stdout.write(block.decode("utf-8", "replace"))
+            sys.stdout.flush()
+        process.wait()
+    finally:
+        timer.cancel()
+        process.stdout.close()
+
+    stdout = b''.join(output)
+    if timed_out.is_set():
+        return subprocess.CompletedProcess(command, -1, stdout + ("\n" + TIMED_OUT).encode("utf-8"))
+    return subprocess.CompletedProcess(command, process.returncode, stdout)
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import types
+
+from flasher import STM32BinaryFlasher
+from performance import FLASH, TUNE
+from tools import FlashError
+
+
+# SWD clock rates (kHz) supported by the STLink/V2 firmware, fastest first
+DEFAULT_FREQUENCIES = (4000, 1800, 950, 480)
+
+# Write chunk sizes to try. None writes the whole image with a single st-flash call.
+DEFAULT_CHUNK_SIZES = (None, 512*1024, 128*1024)
+
+
+class _FlasherProbe:
+    """
+    Lets FlashTuner drive a flasher.STM32BinaryFlasher like an STLink. The flasher always hands st-flash the
+    whole image, so only the SWD clock is tuned for it.
+    """
+    def __init__(self, flasher):
+        if "serial" not in flasher.device or "chip_id" not in flasher.device:
+            raise ValueError("Run check_connection() on the flasher before tuning it.")
+
+        self.flasher = flasher
+        self.stlink = types.SimpleNamespace(serial_number=flasher.device["serial"],
+                                            chip_id=flasher.device["chip_id"], name=str(flasher.device["serial"]))
+
+    def flash(self, binary_file, link_address="0x08000000", freq=None, chunk_size=None, operation=FLASH):
+        self.flasher.flash_device(binary_file, link_address, freq, operation)
+
+
+def _tunable(stlink):
+    return _FlasherProbe(stlink) if isinstance(stlink, STM32BinaryFlasher) else stlink
+
+
+class FlashTuner:
+    """
+    Finds and remembers the fastest SWD clock and write chunk size for each probe and chip family.
+    Long cables need slower clocks than short ones, so a setting is only trusted once a flash using it
+    has passed st-flash's verification on that particular probe.
+    """
+    def __init__(self, settings_file='flash_tuning.json'):
+        if not settings_file.endswith(".json"):
+            raise ValueError("Expected a .json extension for the tuning settings file.")
+
+        self.settings_file = settings_file
+        self.settings = {}
+
+        if os.path.exists(settings_file):
+            with open(settings_file) as file:
+                self.settings = json.loads(file.read())
+
+    @staticmethod
+    def key(serial, chip_id):
+        return "%d:0x%03x" % (serial, chip_id)
+
+    def best(self, serial, chip_id):
+        """
+        Gets the remembered setting for a probe
+        :return: dictionary with 'freq', 'chunk_size' and 'throughput' (bytes/s), or None if not tuned yet
+        """
+        return self.settings.get(self.key(serial, chip_id))
+
+    def forget(self, serial, chip_id):
+        """
+        Drops the remembered setting for a probe, eg after its cable has been changed
+        """
+        self.settings.pop(self.key(serial, chip_id), None)
+        self._save()
+
+    def tune(self, stlink, binary_file, link_address="0x08000000", frequencies=DEFAULT_FREQUENCIES,
+             chunk_sizes=DEFAULT_CHUNK_SIZES):
+        """
+        Flashes an image with every combination of SWD clock and chunk size and remembers the fastest one
+        that succeeded. The board is left programmed with the image.
+        :param stlink: STLink connected to the board being tuned, or an STM32BinaryFlasher that has run
+                       check_connection() (only the SWD clock is tuned for those)
+        :param binary_file: absolute path to the binary used for the measurement
+        :param link_address: program flash link address, defaults to 0x08000000
+        :param frequencies: SWD clock rates (kHz) to try
+        :param chunk_sizes: write chunk sizes to try
+        :return: the chosen setting (see best())
+        """
+        stlink = _tunable(stlink)
+        if isinstance(stlink, _FlasherProbe):
+            chunk_sizes = (None,)
+
+        image_size = os.path.getsize(binary_file)
+        fastest = None
+        last_success = None     # the setting the board was last programmed with
+
+        for freq in frequencies:
+            for chunk_size in chunk_sizes:
+                start = time.perf_counter()
+                try:
+                    stlink.flash(binary_file, link_address, freq=freq, chunk_size=chunk_size, operation=TUNE)
+                except FlashError as error:
+                    print("%d kHz, chunk size %s: failed (%s)" % (freq, chunk_size, error.failure))
+                    continue
+                elapsed = time.perf_counter() - start
+                last_success = (freq, chunk_size)
+
+                throughput = image_size / elapsed
+                print("%d kHz, chunk size %s: %.1f KB/s" % (freq, chunk_size, throughput / 1024))
+
+                if fastest is None or throughput > fastest['throughput']:
+                    fastest = {'freq': freq, 'chunk_size': chunk_size, 'throughput': throughput}
+
+        if fastest is None:
+            raise RuntimeError("Device %s could not be flashed with any of the tuning settings." % stlink.stlink.name)
+
+        # Leave the board programmed using the setting that will be used from now on. If that fails the
+        # FlashError is raised and the setting is not remembered.
+        if last_success != (fastest['freq'], fastest['chunk_size']):
+            stlink.flash(binary_file, link_address, freq=fastest['freq'], chunk_size=fastest['chunk_size'],
+                         operation=TUNE)
+
+        self.settings[self.key(stlink.stlink.serial_number, stlink.stlink.chip_id)] = fastest
+        self._save()
+
+        return fastest
+
+    def flash(self, stlink, binary_file, link_address="0x08000000"):
+        """
+        Flashes a board using its remembered setting, tuning it first if it has never been seen before.
+        If the remembered setting stops working the probe is re-tuned. Raises RuntimeError if no setting works.
+        :param stlink: STLink or STM32BinaryFlasher, see tune()
+        """
+        stlink = _tunable(stlink)
+        setting = self.best(stlink.stlink.serial_number, stlink.stlink.chip_id)
+
+        if setting is not None:
+            try:
+                stlink.flash(binary_file, link_address, freq=setting['freq'], chunk_size=setting['chunk_size'])
+                return
+            except FlashError:
+                print("Remembered setting failed for device %s, re-tuning." % stlink.stlink.name)
+
+        self.tune(stlink, binary_file, link_address)
+
+    def _save(self):
+        with open(self.settings_file, 'w') as file:
+            json.dump(self.settings, file)
@@ -0,0 +1,257 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+SYSFS_USB_DEVICES = '/sys/bus/usb/devices'
+
+# bDeviceClass of USB hubs
+HUB_CLASS = 0x09
+
+
+class UsbNode:
+    """
+    A device in the USB tree. path is the sysfs name, eg 'usb3' for the root hub of bus 3 or '3-1.4' for
+    the device on port 4 of the hub on port 1 of bus 3.
+    """
+    __slots__ = ('path', 'bus', 'address', 'is_hub', 'speed', 'parent', 'children')
+
+    def __init__(self, path, bus, address, is_hub=False, speed=480):
+        self.path = path
+        self.bus = bus
+        self.address = address
+        self.is_hub = is_hub
+        self.speed = speed
+        self.parent = None
+        self.children = []
+
+    @property
+    def port(self):
+        """
+        The port in the <BUS>:<ADDR> format used by USBRecord.port and STLINK_DEVICE
+        """
+        return '%03d:%03d' % (self.bus, self.address)
+
+    def __repr__(self):
+        return "UsbNode(%s, %s%s)" % (self.path, self.port, ", hub" if self.is_hub else "")
+
+
+def _parent_path(path):
+    bus, _, ports = path.partition('-')
+    if '.' in ports:
+        return bus + '-' + ports.rsplit('.', 1)[0]
+    return 'usb' + bus
+
+
+class Topology:
+    """
+    The tree of hubs and devices on the host's USB buses
+    """
+    def __init__(self):
+        self.nodes = {}
+
+    @classmethod
+    def from_sysfs(cls, sysfs_root=SYSFS_USB_DEVICES):
+        """
+        Builds the tree from the kernel's view of the USB buses
+        :param sysfs_root: directory holding the usb device entries, overridable for testing
+        """
+        topology = cls()
+
+        def read(path, name, default=None):
+            try:
+                with open(os.path.join(sysfs_root, path, name)) as file:
+                    return file.read().strip()
+            except OSError:
+                return default
+
+        # Root hubs first, then each level of the tree, so parents are always added before their children
+        paths = sorted(os.listdir(sysfs_root), key=lambda path: (not path.startswith('usb'), path.count('.'), path))
+
+        for path in paths:
+            # Interfaces (eg '3-1:1.0') are not devices
+            if ':' in path:
+                continue
+
+            bus = read(path, 'busnum')
+            address = read(path, 'devnum')
+            if bus is None or address is None:
+                continue
+
+            device_class = int(read(path, 'bDeviceClass', '00'), 16)
+            speed = float(read(path, 'speed', '480'))
+            topology.add(path, int(bus), int(address), device_class == HUB_CLASS, speed)
+
+        return topology
+
+    def add(self, path, bus, address, is_hub=False, speed=480):
+        """
+        Adds a device to the tree. Parents must be added before their children.
+        :return: the new UsbNode
+        """
+        node = UsbNode(path, bus, address, is_hub, speed)
+        self.nodes[path] = node
+
+        if not path.startswith('usb'):
+            parent = self.nodes.get(_parent_path(path))
+            if parent is not None:
+                node.parent = parent
+                parent.children.append(node)
+
+        return node
+
+    def find(self, port):
+        """
+        :param port: port in the <BUS>:<ADDR> format
+        :return: the UsbNode on that port, or None
+        """
+        for node in self.nodes.values():
+            if node.port == port:
+                return node
+        return None
+
+    def hubs_for(self, port):
+        """
+        Gets the hubs a device's traffic passes through, nearest first, ending with the bus' root hub
+        :param port: port in the <BUS>:<ADDR> format
+        """
+        node = self.find(port)
+        hubs = []
+        while node is not None and node.parent is not None:
+            node = node.parent
+            hubs.append(node)
+        return hubs
+
+
+class HubLimiter:
+    """
+    Caps the number of concurrent transfers through one hub. The hub's aggregate throughput is measured
+    over a window of transfers at each cap, and the cap follows whichever level has been fastest, trying
+    one more transfer whenever the current cap is the best one measured so far.
+    """
+    def __init__(self, name, max_transfers, window=2, smoothing=0.5):
+        self.name = name
+        self.max_transfers = max_transfers
+        self.window = window
+        self.smoothing = smoothing
+        self.cap = 1
+        self.active = 0
+
+        # cap -> smoothed aggregate throughput (bytes/s)
+        self.throughput = {}
+
+        self._busy_since = None
+        self._window_busy = 0.0
+        self._window_bytes = 0
+        self._window_count = 0
+
+    def start(self, now):
+        """
+        Called when a transfer through the hub starts
+        """
+        if self.active == 0:
+            self._busy_since = now
+        self.active += 1
+
+    def finish(self, now, transferred):
+        """
+        Called when a transfer through the hub ends. Updates the cap once a full window has been measured.
+        :param now: time.perf_counter() timestamp
+        :param transferred: bytes moved by the transfer, or None if it failed
+        """
+        self.active -= 1
+        if self.active == 0:
+            self._window_busy += now - self._busy_since
+            self._busy_since = None
+
+        if transferred is None:
+            return
+
+        self._window_bytes += transferred
+        self._window_count += 1
+        if self._window_count < self.cap * self.window:
+            return
+
+        # Only time the hub was actually in use counts, idle gaps between jobs say nothing about it
+        busy = self._window_busy
+        if self._busy_since is not None:
+            busy += now - self._busy_since
+            self._busy_since = now
+
+        if busy > 0:
+            aggregate = self._window_bytes / busy
+            previous = self.throughput.get(self.cap)
+            if previous is None:
+                self.throughput[self.cap] = aggregate
+            else:
+                self.throughput[self.cap] = previous + self.smoothing * (aggregate - previous)
+
+            best = max(self.throughput, key=self.throughput.get)
+            if best == self.cap and self.cap < self.max_transfers and self.cap + 1 not in self.throughput:
+                self.cap += 1
+            else:
+                self.cap = best
+
+        self._window_busy = 0.0
+        self._window_bytes = 0
+        self._window_count = 0
+
+
+class TopologyScheduler:
+    """
+    Runs transfers to many probes in parallel without saturating shared hubs. Every hub between a probe
+    and its bus gets a HubLimiter, and a transfer only starts once all of them have a free slot. Each probe
+    only runs one transfer at a time.
+    """
+    def __init__(self, topology, max_per_hub=8):
+        self.topology = topology
+        self.max_per_hub = max_per_hub
+        self.limiters = {}
+        self.active_ports = set()
+        self.condition = threading.Condition()
+
+    def limiter(self, hub):
+        if hub.path not in self.limiters:
+            self.limiters[hub.path] = HubLimiter(hub.path, self.max_per_hub)
+        return self.limiters[hub.path]
+
+    def run(self, jobs):
+        """
+        Runs a batch of transfers
+        :param jobs: list of (usb_port, transfer) tuples, where transfer() moves the data and returns the
+                     number of bytes it transferred
+        :return: list with each transfer's return value, in job order
+        """
+        if not jobs:
+            return []
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as workers:
+            futures = [workers.submit(self._run_one, port, transfer) for port, transfer in jobs]
+            return [future.result() for future in futures]
+
+    def _run_one(self, port, transfer):
+        with self.condition:
+            limiters = [self.limiter(hub) for hub in self.topology.hubs_for(port)]
+
+            # Blocks without polling until the probe is free and every hub on the path has a free slot
+            self.condition.wait_for(lambda: port not in self.active_ports and
+                                    all(limiter.active < limiter.cap for limiter in limiters))
+
+            self.active_ports.add(port)
+            now = time.perf_counter()
+            for limiter in limiters:
+                limiter.start(now)
+
+        transferred = None
+        try:
+            transferred = transfer()
+        finally:
+            with self.condition:
+                now = time.perf_counter()
+                for limiter in limiters:
+                    limiter.finish(now, transferred)
+                self.active_ports.discard(port)
+                self.condition.notify_all()
+
+        return transferred